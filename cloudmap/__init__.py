@@ -1,4 +1,15 @@
-from .live_cloud_maps import CloudMap
+__all__ = ['CloudMap', 'create_session', 'download_all', '__version__']
 
-from . import _version
-__version__ = _version.get_versions()['version']
+
+def __getattr__(name):
+    # the download machinery (requests) and the version (git in a source
+    # checkout) are only loaded when they are used
+    if name in ('CloudMap', 'create_session', 'download_all'):
+        from . import live_cloud_maps
+        return getattr(live_cloud_maps, name)
+    if name == '__version__':
+        from . import _version
+        version = _version.get_versions()['version']
+        globals()['__version__'] = version
+        return version
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,448 @@
+from contextlib import asynccontextmanager, nullcontext
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import os
+import time
+import weakref
+
+import aiohttp
+
+from .live_cloud_maps import (
+    CloudMapBase, RangeError, _content_range_start, _hash_file, _total_size
+)
+from .stats import DownloadStats
+
+# asyncio.Lock of every image written by the coroutines of an event loop
+_path_locks = weakref.WeakKeyDictionary()
+
+
+def _path_lock(path):
+    locks = _path_locks.setdefault(asyncio.get_running_loop(),
+                                   weakref.WeakValueDictionary())
+    key = os.path.abspath(path)
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
+
+class AsyncCloudMap(CloudMapBase):
+
+    """
+    asyncio counterpart of ``CloudMap`` using aiohttp, with the same
+    validators, ``.part`` files and resume behavior
+    """
+
+    transient_errors = (aiohttp.ClientConnectionError,
+                        aiohttp.ClientPayloadError,
+                        asyncio.TimeoutError,
+                        RangeError)
+
+    def __init__(self, outwidth, outheight, session=None, base_url=None,
+                 stats_file=None, metrics=None, progress=None, kernel=None,
+                 postprocess=None, pixel_cache=False, change_detector=None):
+        """
+        Args:
+            * outwidth:
+                width of the downloaded cloud map
+            * outheight:
+                height of the downloaded cloud map
+            * session:
+                ``aiohttp.ClientSession`` used for all requests, a new one
+                is created on first use and closed by ``close`` if not given
+            * base_url:
+                server the maps are downloaded from, see ``CloudMapBase``
+            * stats_file:
+                file the ``DownloadStats`` of every download are appended
+                to as JSON lines
+            * metrics:
+                ``MetricsExporter`` every download is reported to
+            * progress:
+                ``ProgressListener`` notified about the progress of every
+                download, its callbacks run on the event loop
+            * kernel:
+                ``resample.KERNELS`` entry used to scale the map from
+                another resolution, ``CloudMapBase.kernel`` if not given
+            * postprocess:
+                ``postprocess.Pipeline`` applied to the map
+            * pixel_cache:
+                keep the decoded pixels of every new map, see
+                ``CloudMapBase``
+            * change_detector:
+                ``change.ChangeDetector`` scoring every new map
+        """
+
+        super().__init__(outwidth, outheight, base_url)
+        self.session = session
+        self.stats_file = stats_file
+        self.metrics = metrics
+        self.progress = progress
+        if kernel is not None:
+            self.kernel = kernel
+        self.postprocess = postprocess
+        self.pixel_cache = pixel_cache
+        self.change_detector = change_detector
+        self._own_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Close the session, if it was created by this object
+        """
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @staticmethod
+    def _error_status(error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status
+        return None
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    def _timeout(self):
+        return aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                     sock_read=self.read_timeout)
+
+    async def check(self, outdir, outfile):
+        """
+        Check with a conditional HEAD request whether a newer cloud map than
+        the existing image is available
+
+        Args:
+            * outdir:
+                Directory the image is saved in
+            * outfile:
+                Filename of the image
+
+        Returns:
+            ``True`` if the image is missing or a newer one is available
+        """
+        out_path = outdir / Path(outfile)
+        headers = self._request_headers(out_path, False)
+        async with self._get_session().head(
+                self._url, headers=headers, allow_redirects=True,
+                timeout=self._timeout()) as response:
+            self.logger.debug(json.dumps(dict(response.headers), indent=4))
+            if response.status == 304:
+                return False
+            response.raise_for_status()
+            return True
+
+    async def download(self, outdir, outfile, force):
+        """
+        Download cloud map, see ``CloudMap.download``
+
+        Args:
+            * outdir:
+                Directory the image should be saved in
+            * outfile:
+                Filename of the image
+            * force:
+                Force reloading the image
+
+        Returns:
+            ``DownloadStats`` of the download, which is true if a new image
+            was written and false if the existing image is still current
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._rendered():
+            stats, progress = self._rendered_stats(outdir / Path(outfile))
+            # downloads of the source map are reported as part of this map
+            source_map = AsyncCloudMap(
+                *self._source, session=self._get_session(),
+                base_url=self._base_url, progress=progress,
+                change_detector=self.change_detector
+            )
+            source_map.retry = self.retry
+            try:
+                stats.include(await source_map.download(
+                    outdir, self._source_file(), force
+                ))
+                with stats.phase('render'):
+                    async with self._locked(outdir / Path(outfile)):
+                        stats.updated = await loop.run_in_executor(
+                            None, self._derive_decoded,
+                            Path(outdir) / self._source_file(), outdir,
+                            outfile, force
+                        )
+            except Exception as e:
+                self._report_error(stats, e)
+                raise
+            finally:
+                self._report(stats)
+            self._report_result(stats)
+            return stats
+
+        Path(outdir).mkdir(parents=True, exist_ok=True)
+
+        out_path = outdir / Path(outfile)
+
+        stats = DownloadStats(self._url, out_path)
+        if self.progress is not None:
+            self.progress.started(stats)
+        previous = self._read_metadata(out_path)
+        since = time.time()
+        try:
+            async with self._locked(out_path, stats) as (lock, waited):
+                if not (waited and self._coalesce(
+                        lock.result(), since, force, out_path, previous,
+                        stats)):
+                    headers = self._request_headers(out_path, force)
+                    stats.updated = await self._fetch_with_retries(
+                        out_path, headers, stats
+                    )
+                pixels_path = None
+                if self.pixel_cache:
+                    with stats.phase('decode'):
+                        pixels_path = await loop.run_in_executor(
+                            None, self._update_pixels, out_path
+                        )
+                if (stats.updated and not stats.coalesced and
+                        self.change_detector is not None):
+                    with stats.phase('change'):
+                        await loop.run_in_executor(
+                            None, self._detect_change, out_path, stats,
+                            pixels_path
+                        )
+        except Exception as e:
+            self._report_error(stats, e)
+            raise
+        finally:
+            self._report(stats)
+        self._report_result(stats)
+        return stats
+
+    @asynccontextmanager
+    async def _locked(self, out_path, stats=None):
+        """
+        Hold the lock of the image ``out_path`` and store the result of the
+        download described by ``stats`` for the next holder, if they are
+        given
+
+        The coroutines of this event loop wait for each other on an
+        ``asyncio.Lock`` and only the first one polls the file lock of
+        other processes, so no thread of the executor is blocked, which the
+        holder needs to finish.
+
+        Yields:
+            the ``FileLock`` and whether another holder had to be waited for
+        """
+        path_lock = _path_lock(out_path)
+        with (stats.phase('lock wait') if stats is not None
+              else nullcontext()):
+            waited = path_lock.locked()
+            await path_lock.acquire()
+            lock = self._lock(out_path)
+            try:
+                while not lock.try_acquire():
+                    waited = True
+                    await asyncio.sleep(lock.poll_interval)
+            except BaseException:
+                lock.close()
+                path_lock.release()
+                raise
+        try:
+            yield lock, waited
+        finally:
+            try:
+                lock.release(None if stats is None
+                             else self._lock_result(stats))
+            finally:
+                path_lock.release()
+
+    async def _fetch_with_retries(self, out_path, headers, stats):
+        retries = self.retry.retries
+        for attempt in range(retries + 1):
+            stats.attempts += 1
+            try:
+                return await self._fetch(out_path, headers, stats)
+            except Exception as e:
+                if not self._is_transient(e) or attempt == retries:
+                    raise
+                delay = self.retry.delay(attempt)
+                self.logger.warning(
+                    f'{self._url}: {e!r}, retry {attempt + 1}/{retries} in '
+                    f'{delay:.1f} s'
+                )
+                with stats.phase('retry wait'):
+                    await asyncio.sleep(delay)
+
+    async def _fetch(self, out_path, headers, stats):
+        part_file = out_path.with_name(out_path.name + '.part')
+        offset, range_headers = self._resume_headers(part_file)
+        request_headers = {**headers, **range_headers}
+        self.logger.debug(f'request headers: {request_headers}')
+
+        tic = time.perf_counter()
+        async with self._get_session().get(
+                self._url, headers=request_headers, allow_redirects=True,
+                timeout=self._timeout()) as response:
+            stats.add_time('request', time.perf_counter() - tic)
+            stats.status = response.status
+            self.logger.debug(json.dumps(dict(response.headers), indent=4))
+            if self.progress is not None:
+                self.progress.headers(stats, response.headers,
+                                      _total_size(response.headers))
+
+            if response.status == 304:
+                self._discard_part(part_file)
+                self.logger.info(f'{out_path} is new enough')
+                return False
+
+            if response.status == 416:
+                self.logger.debug(f'{part_file} cannot be resumed')
+                self._discard_part(part_file)
+                return await self._fetch(out_path, headers, stats)
+
+            response.raise_for_status()
+            if headers:
+                self.logger.debug(f'{out_path} too old')
+
+            if response.status != 206:
+                offset = 0
+            elif _content_range_start(response.headers) != offset:
+                self.logger.debug(f'{part_file} got unexpected range')
+                self._discard_part(part_file)
+                return await self._fetch(out_path, headers, stats)
+            else:
+                self.logger.debug(f'{part_file} resumed at {offset} bytes')
+
+            return await self._download_image(response, out_path, offset,
+                                              stats)
+
+    async def _download_image(self, response, out_file, offset=0,
+                              stats=None):
+        """
+        Stream the image into the ``.part`` file like
+        ``CloudMap._download_image``, the file operations run in the default
+        executor so the event loop is never blocked by the disk
+        """
+        stats = stats if stats is not None else DownloadStats()
+        loop = asyncio.get_running_loop()
+        part_file = out_file.with_name(out_file.name + '.part')
+
+        if offset:
+            metadata = self._read_metadata(part_file)
+        else:
+            metadata = self._response_metadata(response.headers)
+            await loop.run_in_executor(None, self._write_metadata,
+                                       part_file, metadata)
+
+        length = offset
+        stats.bytes['resumed'] = offset
+        if offset:
+            with stats.phase('hash'):
+                digest = await loop.run_in_executor(None, _hash_file,
+                                                    part_file, offset)
+        else:
+            digest = hashlib.sha256()
+        f = await loop.run_in_executor(None, open, part_file,
+                                       'r+b' if offset else 'wb')
+        total = _total_size(response.headers)
+        tic = time.perf_counter()
+        try:
+            await loop.run_in_executor(None, f.seek, offset)
+            await loop.run_in_executor(None, f.truncate)
+            chunks = response.content.iter_chunked(self.chunk_size)
+            while True:
+                with stats.phase('download'):
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                with stats.phase('write'):
+                    await loop.run_in_executor(None, f.write, chunk)
+                with stats.phase('hash'):
+                    digest.update(chunk)
+                length += len(chunk)
+                stats.add_bytes('received', len(chunk))
+                stats.add_bytes('written', len(chunk))
+                if self.progress is not None:
+                    self._report_chunk(stats, length, total, length - offset,
+                                       tic)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        self.logger.debug(f'{response.url}: length: {length}')
+
+        return await loop.run_in_executor(None, self._finish_download,
+                                          part_file, out_file, metadata,
+                                          digest, stats)
+
+
+async def download_all_async(targets, force=False, max_concurrency=4,
+                             session=None, base_url=None, stats_file=None,
+                             metrics=None, progress=None, kernel=None,
+                             postprocess=None, pixel_cache=False,
+                             change_detector=None):
+    """
+    Download several cloud maps concurrently on the running event loop
+
+    Args:
+        * targets:
+            list of ``(outwidth, outheight, outdir, outfile)`` tuples
+        * force:
+            Force reloading the images
+        * max_concurrency:
+            maximum number of concurrent requests
+        * session:
+            ``aiohttp.ClientSession`` shared by all downloads, a new one is
+            created and closed again if not given
+        * base_url:
+            server the maps are downloaded from, see ``CloudMapBase``
+        * stats_file:
+            file the ``DownloadStats`` of every download are appended to
+        * metrics:
+            ``MetricsExporter`` every download is reported to
+        * progress:
+            ``ProgressListener`` notified about all downloads
+        * kernel:
+            ``resample.KERNELS`` entry used to scale maps from another
+            resolution
+        * postprocess:
+            ``postprocess.Pipeline`` applied to all maps
+        * pixel_cache:
+            keep the decoded pixels of all maps, see ``CloudMapBase``
+        * change_detector:
+            ``change.ChangeDetector`` scoring the downloaded maps
+
+    Returns:
+        list with the result of ``AsyncCloudMap.download`` for every target
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def download(cloud_map, outdir, outfile):
+        async with semaphore:
+            return await cloud_map.download(outdir, outfile, force)
+
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        cloud_maps = [
+            AsyncCloudMap(outwidth, outheight, session=session,
+                          base_url=base_url, stats_file=stats_file,
+                          metrics=metrics, progress=progress, kernel=kernel,
+                          postprocess=postprocess, pixel_cache=pixel_cache,
+                          change_detector=change_detector)
+            for outwidth, outheight, _, _ in targets
+        ]
+        return await asyncio.gather(*[
+            download(cloud_map, outdir, outfile)
+            for cloud_map, (_, _, outdir, outfile) in zip(cloud_maps, targets)
+        ])
+    finally:
+        if own_session:
+            await session.close()
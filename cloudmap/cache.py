@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from .lock import FileLock
+
+
+class MapCache(object):
+
+    """
+    Size-bounded store of downloaded cloud maps, addressed by the SHA-256
+    of their content
+
+    ``index.json`` in the cache directory maps every object to its size,
+    upstream ``Last-Modified`` time and last use, and every URL to the
+    object and validators of its latest image. Objects are evicted least
+    recently used first once the cache grows beyond ``max_bytes``.
+
+    Several processes can share the cache: the index is read again and
+    updated while holding the lock ``index.json.lock``.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            * directory:
+                directory the cached maps and the index are stored in
+            * max_bytes:
+                maximum total size of the cached maps
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.directory / 'index.json'
+        self._index_lock = FileLock(
+            self._index_path.with_name(self._index_path.name + '.lock')
+        )
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('objects', {})
+        index.setdefault('urls', {})
+        return index
+
+    def _write_index(self):
+        tmp_path = self._index_path.with_name(self._index_path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._index, f, indent=4)
+        os.replace(tmp_path, self._index_path)
+
+    @contextmanager
+    def _locked_index(self):
+        """
+        Hold the thread and process locks of the index and read its current
+        state from disk for the ``with`` block
+        """
+        with self._lock:
+            self._index_lock.acquire()
+            try:
+                self._index = self._read_index()
+                yield self._index
+            finally:
+                self._index_lock.release()
+
+    def object_path(self, sha256):
+        return self.directory / f'{sha256}.jpg'
+
+    def lookup(self, url):
+        """
+        Return the metadata (``url``, ``etag``, ``last-modified``,
+        ``sha256``) of the latest cached image of ``url``, or ``None``
+        """
+        with self._locked_index():
+            entry = self._index['urls'].get(url)
+            if entry is None:
+                return None
+            if not self.object_path(entry['sha256']).exists():
+                del self._index['urls'][url]
+                self._index['objects'].pop(entry['sha256'], None)
+                self._write_index()
+                return None
+            return dict(entry, url=url)
+
+    def add(self, path, metadata):
+        """
+        Store the downloaded image ``path`` as latest image of
+        ``metadata['url']``
+
+        Args:
+            * path:
+                downloaded image
+            * metadata:
+                validators of the image including its ``sha256``
+        """
+        sha256 = metadata['sha256']
+        object_path = self.object_path(sha256)
+        with self._locked_index():
+            if not object_path.exists():
+                _link_or_copy(path, object_path)
+            self._index['objects'][sha256] = {
+                'size': object_path.stat().st_size,
+                'last-modified': metadata.get('last-modified'),
+                'used': time.time(),
+            }
+            self._index['urls'][metadata['url']] = {
+                key: metadata.get(key)
+                for key in ('etag', 'last-modified', 'sha256')
+            }
+            self._evict(keep=sha256)
+            self._write_index()
+
+    def restore(self, entry, out_path):
+        """
+        Link or copy the cached image of ``entry`` (as returned by
+        ``lookup``) atomically to ``out_path``
+        """
+        object_path = self.object_path(entry['sha256'])
+        with self._locked_index():
+            part_file = out_path.with_name(out_path.name + '.part')
+            part_file.unlink(missing_ok=True)
+            _link_or_copy(object_path, part_file)
+            os.replace(part_file, out_path)
+            info = self._index['objects'].get(entry['sha256'])
+            if info is not None:
+                info['used'] = time.time()
+                self._write_index()
+
+    def _evict(self, keep):
+        objects = self._index['objects']
+        # objects missing in the index, e.g. lost by older versions which
+        # overwrote the index of a concurrent process
+        for path in self.directory.glob('*.jpg'):
+            if path.stem not in objects:
+                stat = path.stat()
+                objects[path.stem] = {'size': stat.st_size,
+                                      'last-modified': None,
+                                      'used': stat.st_mtime}
+        total = sum(info['size'] for info in objects.values())
+        for sha256 in sorted(objects, key=lambda s: objects[s]['used']):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            total -= objects.pop(sha256)['size']
+            self.object_path(sha256).unlink(missing_ok=True)
+            self._index['urls'] = {
+                url: entry for url, entry in self._index['urls'].items()
+                if entry['sha256'] != sha256
+            }
+            self.logger.debug(f'evicted {sha256} from cache')
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard link ``source`` to ``destination``, or copy it if the file system
+    does not support links
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
@@ -0,0 +1,103 @@
+"""
+Detection of insignificant updates of the cloud maps by comparing small
+brightness signatures of consecutive maps
+"""
+from pathlib import Path
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class ChangeDetector(object):
+
+    """
+    Score how much a new map differs from the previous one
+
+    Every map is reduced to a signature of ``size`` cells with the mean
+    brightness of its pixels, which is kept in ``.<outfile>.signature.npy``
+    next to the map. The score of a new map is the share of the cells whose
+    brightness changed by more than ``tolerance`` levels, so noise of the
+    JPEG compression is ignored. The update is significant if the score
+    reaches ``threshold``.
+    """
+
+    size = (256, 128)
+
+    def __init__(self, threshold=0.01, tolerance=8):
+        """
+        Args:
+            * threshold:
+                smallest share of changed cells (0 to 1) of a significant
+                update
+            * tolerance:
+                brightness difference (0 to 255) a cell has to exceed to
+                count as changed
+        """
+        self.threshold = threshold
+        self.tolerance = tolerance
+
+    @staticmethod
+    def signature_path(out_path):
+        out_path = Path(out_path)
+        return out_path.with_name(f'.{out_path.name}.signature.npy')
+
+    def signature(self, out_path, pixels=None):
+        """
+        Return the signature of the map ``out_path`` as ``uint8`` array of
+        shape ``(height, width)``, computed from its decoded ``pixels``
+        (e.g. from ``CloudMapBase.decoded``) if they are given, otherwise
+        from a reduced decode of the image
+        """
+        width, height = self.size
+        if (pixels is None or pixels.shape[0] < height or
+                pixels.shape[1] < width):
+            with Image.open(out_path) as image:
+                # JPEG images are decoded at a fraction of their size
+                image.draft('L', (width, height))
+                return np.asarray(
+                    image.convert('L').resize(self.size, Image.BOX)
+                )
+
+        rows = np.linspace(0, pixels.shape[0], height + 1).astype(int)
+        columns = np.linspace(0, pixels.shape[1], width + 1).astype(int)
+        result = np.empty((height, width))
+        for i in range(height):
+            block = np.asarray(pixels[rows[i]:rows[i + 1]],
+                               dtype=np.float32)
+            if block.ndim == 3 and block.shape[2] < 3:
+                # gray with alpha
+                block = block[..., 0]
+            elif block.ndim == 3:
+                # ITU-R 601-2 luma like the conversion to "L" of Pillow
+                block = block[..., :3] @ np.array([0.299, 0.587, 0.114],
+                                                  dtype=np.float32)
+            sums = np.add.reduceat(block.sum(axis=0), columns[:-1])
+            result[i] = sums / (np.diff(columns) * (rows[i + 1] - rows[i]))
+        return np.rint(result).astype(np.uint8)
+
+    def score(self, out_path, pixels=None):
+        """
+        Return the share of changed cells of the map ``out_path`` compared
+        with the previous map (1.0 if there is none) and keep its signature
+        for the next comparison
+        """
+        current = self.signature(out_path, pixels)
+        path = self.signature_path(out_path)
+        try:
+            previous = np.load(path)
+        except (OSError, ValueError):
+            previous = None
+
+        tmp_path = path.with_name(path.name + '.part')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, current)
+        os.replace(tmp_path, path)
+
+        if previous is None or previous.shape != current.shape:
+            return 1.0
+        difference = np.abs(current.astype(np.int16) - previous)
+        return float(np.mean(difference > self.tolerance))
+
+    def significant(self, score):
+        return score >= self.threshold
@@ -7,10 +7,353 @@ from __future__ import division
 import argparse
 import configparser
 import os
+import random
+import signal
+import threading
 import timeit
 import logging
 
-from .__init__ import CloudMap, __version__
+from pathlib import Path
+
+from .cache import MapCache
+from .metrics import MetricsExporter, MetricsServer
+from .mirrors import MirrorPool
+from .retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+# the download machinery (requests) is imported where it is needed, so that
+# --help, --version and runs stopped by the circuit breaker start quickly
+
+
+def parse_resolution(spec):
+    """
+    Parse a resolution given as ``WIDTHxHEIGHT[:FILE]``
+
+    Returns:
+        tuple ``(width, height, filename)``, the filename defaults to
+        ``clouds_<width>.jpg``
+    """
+    size, _, outfile = spec.strip().partition(':')
+    width, _, height = size.lower().partition('x')
+    width, height = int(width), int(height)
+    return width, height, outfile or f'clouds_{width}.jpg'
+
+
+def read_settings(args):
+    """
+    Read the config file and combine it with the command line arguments
+
+    Returns:
+        dictionary with the download targets and options
+    """
+    config = configparser.ConfigParser(
+        {'width': '2048',
+         'height': '1024',
+         'destinationfile': 'clouds_2048.jpg',
+         'resolutions': '',
+         'jobs': '4',
+         'derive': 'no',
+         'segments': '1',
+         'resample': 'box',
+         'postprocess': '',
+         'pixelcache': 'no',
+         'changethreshold': '',
+         'interval': '600',
+         'jitter': '60',
+         'schedule': 'fixed',
+         'mininterval': '60',
+         'maxinterval': '3600',
+         'window': '600',
+         'cachedir': '',
+         'cachesize': '512',
+         'baseurl': '',
+         'mirrors': '',
+         'retries': '3',
+         'backoff': '0.5',
+         'maxbackoff': '30',
+         'breakerthreshold': '3',
+         'breakertimeout': '300',
+         'statsfile': '',
+         'metricsfile': '',
+         'metricslisten': '',
+         'listen': ':8080',
+         }
+        )
+    config.read([args.conf_file])
+
+    outdir = config.get("xplanet", 'destinationdir')
+    outfile = config.get("xplanet", 'destinationfile')
+
+    if args.serve:
+        from .mirror_server import mirror_targets
+        resolutions = [
+            (width, height, filename)
+            for width, height, _, filename in mirror_targets(outdir)
+        ]
+    elif args.resolution:
+        resolutions = args.resolution
+    elif config.get("xplanet", 'resolutions').split():
+        resolutions = [
+            parse_resolution(spec)
+            for spec in config.get("xplanet", 'resolutions').split()
+        ]
+    else:
+        outwidth = int(config.get("xplanet", 'width'))
+        outheight = int(config.get("xplanet", 'height'))
+        resolutions = [(outwidth, outheight, outfile)]
+
+    return {
+        'targets': [(width, height, outdir, filename)
+                    for width, height, filename in resolutions],
+        'jobs': args.jobs or int(config.get("xplanet", 'jobs')),
+        'derive': args.derive or config.getboolean("xplanet", 'derive'),
+        'segments': args.segments or int(config.get("xplanet", 'segments')),
+        'resample': config.get("xplanet", 'resample'),
+        # the mirror serves the maps as they are upstream
+        'postprocess': ('' if args.serve
+                        else config.get("xplanet", 'postprocess')),
+        'pixelcache': config.getboolean("xplanet", 'pixelcache'),
+        'changethreshold': config.get("xplanet", 'changethreshold'),
+        'interval': args.interval or float(config.get("xplanet",
+                                                      'interval')),
+        'jitter': float(config.get("xplanet", 'jitter')),
+        'schedule': args.schedule or config.get("xplanet", 'schedule'),
+        'mininterval': float(config.get("xplanet", 'mininterval')),
+        'maxinterval': float(config.get("xplanet", 'maxinterval')),
+        'window': float(config.get("xplanet", 'window')),
+        'cachedir': config.get("xplanet", 'cachedir'),
+        'cachesize': float(config.get("xplanet", 'cachesize')),
+        'baseurl': config.get("xplanet", 'baseurl') or None,
+        'mirrors': config.get("xplanet", 'mirrors').split(),
+        'retries': int(config.get("xplanet", 'retries')),
+        'backoff': float(config.get("xplanet", 'backoff')),
+        'maxbackoff': float(config.get("xplanet", 'maxbackoff')),
+        'breakerthreshold': int(config.get("xplanet", 'breakerthreshold')),
+        'breakertimeout': float(config.get("xplanet", 'breakertimeout')),
+        'breakerfile': Path(outdir) / 'circuit.json',
+        'statsfile': (os.path.expanduser(config.get("xplanet", 'statsfile'))
+                      or None),
+        'metricsfile': (os.path.expanduser(config.get("xplanet",
+                                                      'metricsfile'))
+                        or None),
+        'metricslisten': config.get("xplanet", 'metricslisten'),
+        'listen': config.get("xplanet", 'listen'),
+    }
+
+
+def create_cache(settings):
+    """
+    Create the ``MapCache`` in ``cachedir`` limited to ``cachesize`` MB, or
+    return ``None`` if no cache directory is configured
+    """
+    if not settings['cachedir']:
+        return None
+    return MapCache(os.path.expanduser(settings['cachedir']),
+                    int(settings['cachesize'] * 1024 * 1024))
+
+
+def create_mirrors(settings):
+    """
+    Create the ``MirrorPool`` of the configured ``mirrors``, or return
+    ``None`` to download from ``baseurl`` only
+    """
+    if not settings['mirrors']:
+        return None
+    return MirrorPool(settings['mirrors'])
+
+
+def create_breaker(settings):
+    """
+    Create the ``CircuitBreaker`` kept in ``circuit.json`` of the destination
+    directory, or return ``None`` if ``breakerthreshold`` is 0
+    """
+    if settings['breakerthreshold'] <= 0:
+        return None
+    return CircuitBreaker(settings['breakerfile'],
+                          failure_threshold=settings['breakerthreshold'],
+                          reset_timeout=settings['breakertimeout'])
+
+
+def create_metrics(settings):
+    """
+    Create the ``MetricsExporter`` writing ``metricsfile``, or return
+    ``None`` if neither ``metricsfile`` nor ``metricslisten`` is configured
+    """
+    if not settings['metricsfile'] and not settings['metricslisten']:
+        return None
+    return MetricsExporter(settings['targets'], settings['metricsfile'])
+
+
+def create_pipeline(settings):
+    """
+    Create the ``Pipeline`` of the ``postprocess`` operations, or return
+    ``None`` if there are none
+    """
+    if not settings['postprocess'].strip():
+        return None
+    from .postprocess import Pipeline
+    return Pipeline(settings['postprocess'])
+
+
+def create_change_detector(settings):
+    """
+    Create the ``ChangeDetector`` with the configured threshold (in
+    percent), or return ``None`` if there is none
+    """
+    if not settings['changethreshold'].strip():
+        return None
+    from .change import ChangeDetector
+    return ChangeDetector(float(settings['changethreshold']) / 100)
+
+
+def refresh(settings, force, session=None, cache=None, mirrors=None,
+            metrics=None):
+    """
+    Download all cloud maps of ``settings`` which are not up to date
+    """
+    from .live_cloud_maps import download_all
+    return download_all(
+        settings['targets'], force, max_workers=settings['jobs'],
+        session=session, derive=settings['derive'],
+        segments=settings['segments'], cache=cache,
+        base_url=settings['baseurl'], mirrors=mirrors,
+        retry=RetryPolicy(settings['retries'], settings['backoff'],
+                          settings['maxbackoff']),
+        breaker=create_breaker(settings), stats_file=settings['statsfile'],
+        metrics=metrics, kernel=settings['resample'],
+        postprocess=create_pipeline(settings),
+        pixel_cache=settings['pixelcache'],
+        change_detector=create_change_detector(settings)
+    )
+
+
+def create_scheduler(settings):
+    """
+    Create the ``AdaptiveScheduler`` for the history of the largest cloud
+    map, or return ``None`` for the fixed poll interval
+    """
+    if settings['schedule'] != 'adaptive':
+        return None
+    from .live_cloud_maps import history_path
+    from .scheduler import AdaptiveScheduler
+    width, height, outdir, outfile = max(settings['targets'],
+                                         key=lambda t: t[0] * t[1])
+    return AdaptiveScheduler(
+        history_path(Path(outdir) / outfile),
+        min_interval=settings['mininterval'],
+        max_interval=settings['maxinterval'],
+        window=settings['window'],
+        default_interval=settings['interval'],
+    )
+
+
+def watch(args, settings, server=None):
+    """
+    Keep refreshing the cloud maps every ``interval`` seconds (plus a random
+    jitter) with one connection pool, until SIGTERM or SIGINT is received.
+    With the adaptive schedule the interval follows the update history.
+    SIGHUP reloads the config file. The maps served by the ``MirrorServer``
+    ``server`` are updated after every refresh. The metrics are written
+    after every refresh and served on ``metricslisten``.
+    """
+    from .live_cloud_maps import create_session
+    logger = logging.getLogger('create_map_logger')
+
+    wakeup = threading.Event()
+    state = {'stop': False, 'reload': False}
+
+    def stop(signum, frame):
+        logger.info(f'received signal {signum}, stopping')
+        state['stop'] = True
+        wakeup.set()
+
+    def reload(signum, frame):
+        state['reload'] = True
+        wakeup.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload)
+
+    session = create_session(
+        pool_maxsize=settings['jobs'] * settings['segments']
+    )
+    scheduler = create_scheduler(settings)
+    cache = create_cache(settings)
+    mirrors = create_mirrors(settings)
+    metrics = create_metrics(settings)
+    metrics_server = None
+    if metrics is not None and settings['metricslisten']:
+        host, _, port = settings['metricslisten'].rpartition(':')
+        metrics_server = MetricsServer(metrics, (host, int(port)))
+        metrics_server.start()
+    force = args.force
+    while not state['stop']:
+        if state['reload']:
+            state['reload'] = False
+            try:
+                settings = read_settings(args)
+                scheduler = create_scheduler(settings)
+                cache = create_cache(settings)
+                mirrors = create_mirrors(settings)
+                if metrics is not None:
+                    metrics.targets = settings['targets']
+                logger.info(f'reloaded {args.conf_file}')
+            except Exception as e:
+                logger.error(f'cannot reload {args.conf_file}: {e}')
+
+        tic = timeit.default_timer()
+        try:
+            refresh(settings, force, session, cache, mirrors, metrics)
+        except Exception as e:
+            logger.error(f'refresh failed: {e}')
+        if metrics is not None:
+            metrics.write()
+        if server is not None:
+            server.targets = settings['targets']
+            server.reload()
+        force = False
+        toc = timeit.default_timer()
+        logger.debug("refresh finished in {:.1f} s".format((toc - tic)))
+
+        if scheduler is None:
+            delay = settings['interval']
+        else:
+            scheduler.record_poll(
+                1 if settings['derive'] else len(settings['targets'])
+            )
+            delay = scheduler.next_delay()
+        # short delays must not be stretched by the jitter
+        delay += random.uniform(0, min(settings['jitter'], delay * 0.1))
+        logger.debug(f'next refresh in {delay:.0f} s')
+        wakeup.wait(delay)
+        wakeup.clear()
+    session.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if mirrors is not None:
+        logger.debug(f'mirrors: {mirrors.status()}')
+    if scheduler is not None:
+        logger.info(scheduler.summary())
+
+
+class VersionAction(argparse.Action):
+
+    """
+    Print the version and exit like ``action='version'``, but determine the
+    version only if it is asked for
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from . import __version__
+        print(__version__)
+        parser.exit()
 
 
 def main():
@@ -32,31 +375,82 @@ def main():
                             "~/.CreateCloudMap/CreateCloudMap.ini"))
     parser.add_argument("-f", "--force", help="Force to recreate cloud map",
                         action="store_true")
-    parser.add_argument('-V', '--version', action='version',
-                        version=__version__)
+    parser.add_argument("-r", "--resolution",
+                        help="Download the cloud map with this resolution, "
+                        "optionally saved as FILE (can be given several "
+                        "times)",
+                        metavar="WIDTHxHEIGHT[:FILE]", action="append",
+                        type=parse_resolution)
+    parser.add_argument("--derive",
+                        help="Only download the largest resolution and "
+                        "derive the smaller ones locally",
+                        action="store_true")
+    parser.add_argument("-s", "--segments",
+                        help="Download large images in this number of "
+                        "parallel byte ranges",
+                        type=int)
+    parser.add_argument("-j", "--jobs",
+                        help="Maximum number of concurrent downloads",
+                        type=int)
+    parser.add_argument("-w", "--watch",
+                        help="Keep running and refresh the cloud maps "
+                        "periodically",
+                        action="store_true")
+    parser.add_argument("-i", "--interval",
+                        help="Seconds between two refreshes in watch mode",
+                        type=float)
+    parser.add_argument("--serve",
+                        help="Mirror all resolutions and serve them over "
+                        "HTTP to other nodes (implies --watch)",
+                        action="store_true")
+    parser.add_argument("--schedule",
+                        help="Poll at a fixed interval or adapt to the "
+                        "update history in watch mode",
+                        choices=['fixed', 'adaptive'])
+    parser.add_argument('-V', '--version', action=VersionAction)
     args = parser.parse_args()
-    config = configparser.ConfigParser(
-        {'width': '2048',
-         'height': '1024',
-         'destinationfile': 'clouds_2048.jpg',
-         }
-        )
-    config.read([args.conf_file])
-
-    outdir = config.get("xplanet", 'destinationdir')
-    outfile = config.get("xplanet", 'destinationfile')
 
     if args.debug:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
-    outwidth = int(config.get("xplanet", 'width'))
-    outheight = int(config.get("xplanet", 'height'))
+    settings = read_settings(args)
+
+    if args.serve:
+        from .mirror_server import MirrorServer
+        host, _, port = settings['listen'].rpartition(':')
+        server = MirrorServer(settings['targets'], (host, int(port)))
+        server.start()
+        try:
+            watch(args, settings, server)
+        finally:
+            server.shutdown()
+        return
 
-    satellite_list = CloudMap(outwidth, outheight)
+    if args.watch:
+        watch(args, settings)
+        return
 
-    satellite_list.download(outdir, outfile, args.force)
+    metrics = create_metrics(settings)
+    breaker = create_breaker(settings)
+    if breaker is not None and breaker.retry_in() > 0:
+        # fail without loading the download machinery, the existing maps
+        # are kept as they are
+        logger.error(f'circuit open, next attempt in '
+                     f'{breaker.retry_in():.0f} s, keeping the existing maps')
+        if metrics is not None:
+            metrics.write()
+        raise SystemExit(1)
+    try:
+        refresh(settings, args.force, cache=create_cache(settings),
+                mirrors=create_mirrors(settings), metrics=metrics)
+    except CircuitOpenError:
+        # already logged for every map, which is kept as it is
+        raise SystemExit(1)
+    finally:
+        if metrics is not None:
+            metrics.write()
 
     toc = timeit.default_timer()
 
@@ -1,16 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import timezone
 from pathlib import Path
+import threading
 import requests
-from datetime import datetime, timezone
-from dateutil import parser
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
 import json
 import os
 import logging
+import shutil
+import time
+import timeit
 
+from .lock import FileLock
+from .progress import SourceProgress
+from .retry import RetryPolicy
+from .stats import DownloadStats, write_stats
 
-class CloudMap(object):
 
+class RangeError(requests.exceptions.RequestException):
     """
-    Class to download and process the could map from clouds.matteason.co.uk
+    The server did not answer a range request with the requested range
+    """
+
+
+def create_session(pool_connections=10, pool_maxsize=10):
+    """
+    Create a ``requests.Session`` with a keep-alive connection pool, which
+    can be shared by several ``CloudMap`` objects
+
+    Args:
+        * pool_connections:
+            number of hosts to keep connection pools for
+        * pool_maxsize:
+            maximum number of connections kept alive per host
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class CloudMapBase(object):
+
+    """
+    Resolution handling and freshness logic shared by ``CloudMap`` and
+    ``AsyncCloudMap``
+
+    Maps of a resolution not in ``available_resolutions`` are scaled with
+    ``kernel`` from the smallest available resolution covering them (or
+    the largest one), which is kept in ``.clouds_<width>x<height>.jpg`` in
+    the same directory. The same happens for maps post-processed by a
+    ``postprocess.Pipeline``.
+
+    With ``pixel_cache`` the decoded pixels of every new map are kept in
+    ``.<outfile>.<timestamp>.pixels`` next to it, see ``decoded``. A
+    ``change.ChangeDetector`` scores every new map against the previous
+    one, a rendered map is scored by its source map.
     """
 
     available_resolutions = [
@@ -20,35 +70,778 @@ class CloudMap(object):
         (8192, 4096),
     ]
 
-    def __init__(self, outwidth, outheight):
+    chunk_size = 64 * 1024
+    connect_timeout = 10
+    read_timeout = 20
+    retry = RetryPolicy()
+    breaker = None
+    history_size = 100
+    cache = None
+    stats_file = None
+    metrics = None
+    progress = None
+    kernel = 'box'
+    postprocess = None
+    pixel_cache = False
+    change_detector = None
+    default_base_url = 'https://clouds.matteason.co.uk'
+
+    def __init__(self, outwidth, outheight, base_url=None):
         """
         Args:
             * outwidth:
                 width of the downloaded cloud map
             * outheight:
                 height of the downloaded cloud map
-            * debug
-                print debug outputs
+            * base_url:
+                server the ``/images/<width>x<height>/clouds.jpg`` maps are
+                downloaded from, ``default_base_url`` if not given
         """
 
         self.logger = logging.getLogger('create_map_logger')
 
-        if (outwidth, outheight) not in CloudMap.available_resolutions:
-            self.logger.error(
-                f'{outwidth}, {outheight} no valid resolution!\n' +
-                f'resolutions available: {CloudMap.available_resolutions}'
-            )
+        if outwidth <= 0 or outheight <= 0:
+            self.logger.error(f'{outwidth}, {outheight} no valid resolution!')
             raise ValueError(f'{outwidth}, {outheight} no valid resolution')
 
-        self._url = (
-            'https://clouds.matteason.co.uk/images/' +
-            f'{outwidth}x{outheight}/clouds.jpg'
-        )
+        self._base_url = (base_url or self.default_base_url).rstrip('/')
+        self._size = (outwidth, outheight)
+        self._source = self.source_resolution(outwidth, outheight)
+        self._path = '/images/{}x{}/clouds.jpg'.format(*self._source)
+        self._url = self._base_url + self._path
+
+    @classmethod
+    def source_resolution(cls, outwidth, outheight):
+        """
+        Return the smallest available resolution at least as large as
+        ``outwidth`` x ``outheight``, or the largest one
+        """
+        def area(size):
+            return size[0] * size[1]
+
+        covering = [
+            (width, height) for width, height in cls.available_resolutions
+            if width >= outwidth and height >= outheight
+        ]
+        if not covering:
+            return max(cls.available_resolutions, key=area)
+        return min(covering, key=area)
+
+    def _source_file(self):
+        return '.clouds_{}x{}.jpg'.format(*self._source)
+
+    def _rendered(self):
+        """
+        Return whether the map is rendered locally from a downloaded source
+        map instead of being downloaded as it is
+        """
+        return self._source != self._size or self.postprocess is not None
+
+    def _raw_path(self, outdir, outfile):
+        """
+        Return the path of the map as downloaded from upstream
+        """
+        if self._rendered():
+            return Path(outdir) / self._source_file()
+        return Path(outdir) / outfile
+
+    # exceptions of the HTTP client worth retrying, besides 5xx responses
+    transient_errors = ()
+
+    @staticmethod
+    def _error_status(error):
+        """
+        Return the HTTP status of an error response ``error`` of the HTTP
+        client, ``None`` for other errors
+        """
+        return None
+
+    def _is_transient(self, error):
+        """
+        Return whether a failed request is worth retrying: server errors
+        and the ``transient_errors`` of the client
+        """
+        status = self._error_status(error)
+        if status is not None:
+            return status >= 500
+        return isinstance(error, self.transient_errors)
+
+    def _request_headers(self, out_path, force):
+        """
+        Return the validator headers of the request for ``out_path``, which
+        are empty if the image is missing or should be reloaded
+        """
+        if force:
+            self.logger.info(f'{out_path} forcefully downloaded')
+            return {}
+        if not out_path.exists():
+            self.logger.debug(f'{out_path} not found')
+            return {}
+        return self._conditional_headers(out_path)
+
+    def _conditional_headers(self, out_path):
+        """
+        Build the ``If-None-Match``/``If-Modified-Since`` headers from the
+        validators stored next to ``out_path``. Maps written by older
+        versions without metadata fall back to the file modification time.
+        Maps rendered locally by ``derive`` get no validators, they are
+        replaced by the image as it is upstream.
+        """
+        metadata = self._read_metadata(out_path)
+        if any(key in metadata
+               for key in ('source-sha256', 'kernel', 'postprocess')):
+            self.logger.debug(f'{out_path} was rendered locally')
+            return {}
+        if metadata.get('url') != self._url:
+            mtime = out_path.stat().st_mtime
+            return {'If-Modified-Since': formatdate(mtime, usegmt=True)}
+        return self._validator_headers(metadata)
+
+    @staticmethod
+    def _validator_headers(metadata):
+        headers = {}
+        if metadata.get('etag'):
+            headers['If-None-Match'] = metadata['etag']
+        if metadata.get('last-modified'):
+            headers['If-Modified-Since'] = metadata['last-modified']
+        return headers
+
+    @staticmethod
+    def _metadata_path(out_path):
+        return out_path.with_name(out_path.name + '.json')
+
+    @staticmethod
+    def _lock(out_path):
+        return FileLock(out_path.with_name(out_path.name + '.lock'))
+
+    def _coalesce(self, result, since, force, out_path, previous, stats):
+        """
+        Reuse the ``result`` of a download of ``out_path`` by another
+        process, which was waited for since ``since``, if it finished
+        successfully in the meantime (and wrote a new image, if ``force``
+        is set). ``stats.updated`` tells whether the content differs from
+        the one described by the ``previous`` metadata (or, unless
+        ``force`` is set and without hashes, the metadata itself).
+
+        Returns:
+            ``True`` if the result was reused
+        """
+        if (result.get('finished', 0) < since or result.get('error') or
+                (force and not result.get('updated'))):
+            return False
+        stats.coalesced = True
+        stats.change = result.get('change')
+        stats.significant = result.get('significant')
+        current = self._read_metadata(out_path)
+        if current.get('sha256') and current['sha256'] == previous.get(
+                'sha256'):
+            stats.updated = False
+            stats.unchanged = current != previous
+        else:
+            stats.updated = force or current != previous
+        self.logger.info(f'{out_path} was just '
+                         f'{"updated" if stats.updated else "checked"} '
+                         f'by another process')
+        return True
+
+    @staticmethod
+    def _lock_result(stats):
+        return {'finished': time.time(), 'updated': stats.updated,
+                'error': stats.error, 'change': stats.change,
+                'significant': stats.significant}
+
+    def _read_metadata(self, out_path):
+        try:
+            with open(self._metadata_path(out_path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_metadata(self, out_path, metadata):
+        meta_path = self._metadata_path(out_path)
+        tmp_path = meta_path.with_name(meta_path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f, indent=4)
+        os.replace(tmp_path, meta_path)
+
+    def _resume_headers(self, part_file):
+        """
+        Return the offset and the ``Range``/``If-Range`` headers to continue
+        the partial download in ``part_file``
+        """
+        metadata = self._read_metadata(part_file)
+        validator = _range_validator(metadata)
+        if (metadata.get('url') != self._url or not validator or
+                not part_file.exists()):
+            return 0, {}
+
+        offset = part_file.stat().st_size
+        if not offset:
+            return 0, {}
+        return offset, {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+    def _discard_part(self, part_file):
+        part_file.unlink(missing_ok=True)
+        self._metadata_path(part_file).unlink(missing_ok=True)
+
+    def _response_metadata(self, headers):
+        return {
+            'url': self._url,
+            'etag': headers.get('etag'),
+            'last-modified': headers.get('last-modified'),
+        }
+
+    def _finish_download(self, part_file, out_file, metadata, digest=None,
+                         stats=None):
+        """
+        Set the modification time of the complete ``part_file``, rename it
+        to ``out_file`` and store its validators, SHA-256 and update
+        history. The image is also added to the cache, if there is one.
+
+        If ``out_file`` already has the same content, it is kept and only
+        its metadata is updated, see ``_keep_content``.
+
+        ``digest`` is the ``hashlib.sha256`` of the streamed content, it is
+        computed from ``part_file`` if not given. The time of these steps is
+        added to ``stats``.
+
+        Returns:
+            ``True`` if ``out_file`` was replaced
+        """
+        stats = stats if stats is not None else DownloadStats()
+        if digest is None:
+            with stats.phase('hash'):
+                digest = _hash_file(part_file)
+        metadata = dict(metadata, sha256=digest.hexdigest())
+        with stats.phase('hash'):
+            unchanged = self._same_content(out_file, metadata['sha256'],
+                                           part_file.stat().st_size)
+        with stats.phase('rename'):
+            if unchanged:
+                part_file.unlink()
+                self._metadata_path(part_file).unlink(missing_ok=True)
+                self._keep_content(out_file, metadata, stats)
+            else:
+                if metadata.get('last-modified'):
+                    modified = http_date_timestamp(metadata['last-modified'])
+                    os.utime(part_file, (modified, modified))
+                os.replace(part_file, out_file)
+                self._metadata_path(part_file).unlink(missing_ok=True)
+                self._write_metadata(out_file, metadata)
+                if metadata.get('last-modified'):
+                    self._record_history(out_file, modified)
+        if self.cache is not None:
+            with stats.phase('cache'):
+                self.cache.add(out_file, metadata)
+        if not unchanged:
+            self.logger.debug(f'downloaded {out_file}')
+        return not unchanged
+
+    def _same_content(self, out_path, sha256, size=None):
+        """
+        Return whether ``out_path`` has the content with the SHA-256
+        ``sha256`` (and ``size`` bytes). Only a file whose metadata has this
+        hash is hashed again, so a damaged file is replaced.
+        """
+        if not sha256 or self._read_metadata(out_path).get('sha256') != sha256:
+            return False
+        try:
+            if size is not None and out_path.stat().st_size != size:
+                return False
+            return _hash_file(out_path).hexdigest() == sha256
+        except OSError:
+            return False
+
+    def _keep_content(self, out_path, metadata, stats=None):
+        """
+        Keep ``out_path``, whose content equals the new image described by
+        ``metadata``, and only store the new metadata, modification time and
+        history, so nothing watching the content has to process it again.
+        ``stats.unchanged`` is set.
+        """
+        if metadata.get('last-modified'):
+            modified = http_date_timestamp(metadata['last-modified'])
+            os.utime(out_path, (modified, modified))
+            self._record_history(out_path, modified)
+        self._write_metadata(out_path, metadata)
+        if stats is not None:
+            stats.unchanged = True
+        self.logger.info(f'{out_path} has unchanged content')
+
+    def _report(self, stats):
+        """
+        Log the timing of a finished download, append it to ``stats_file``
+        and add it to the ``metrics``, if there are any
+        """
+        stats.finish()
+        self.logger.debug(str(stats))
+        if self.stats_file is not None:
+            write_stats(self.stats_file, stats)
+        if self.metrics is not None:
+            self.metrics.observe(self._size, stats)
+
+    def _report_chunk(self, stats, received, total, transferred, tic):
+        """
+        Pass the progress of a body read since ``tic`` with ``transferred``
+        bytes in this response to the ``progress`` listener
+        """
+        elapsed = time.perf_counter() - tic
+        self.progress.chunk(stats, received, total,
+                            transferred / elapsed if elapsed > 0 else 0.0)
+
+    def _restore_from_cache(self, entry, out_path, stats=None):
+        """
+        Replace ``out_path`` by the cached image of ``entry``, unless it
+        already has the same content
+
+        Returns:
+            ``True`` if ``out_path`` was replaced
+        """
+        if self._same_content(out_path, entry.get('sha256')):
+            self._keep_content(out_path, entry, stats)
+            return False
+        self.cache.restore(entry, out_path)
+        self._write_metadata(out_path, entry)
+        self.logger.info(f'{out_path} restored from cache')
+        return True
+
+    def _record_history(self, out_file, last_modified):
+        """
+        Append the ``Last-Modified`` time of a new image and the time it was
+        downloaded to ``<outfile>.history``, keeping the last
+        ``history_size`` entries
+        """
+        entries = read_history(history_path(out_file))
+        if entries and entries[-1][0] == last_modified:
+            return
+        entries.append((last_modified, time.time()))
+
+        path = history_path(out_file)
+        tmp_path = path.with_name(path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            for modified, seen in entries[-self.history_size:]:
+                f.write(json.dumps({'last-modified': modified,
+                                    'seen': seen}) + '\n')
+        os.replace(tmp_path, path)
+
+    def _pixels_timestamp(self, out_path):
+        """
+        Return the upstream ``Last-Modified`` time of ``out_path``, which
+        identifies the version of its pixels, or its modification time
+        """
+        last_modified = self._read_metadata(out_path).get('last-modified')
+        if last_modified:
+            return http_date_timestamp(last_modified)
+        return out_path.stat().st_mtime
+
+    def _update_pixels(self, out_path):
+        """
+        Decode ``out_path`` into its pixel file unless that is current and
+        remove the pixel files of older versions, while holding the lock of
+        ``out_path``. The pixels of an older version with the same content
+        are renamed instead of decoding the image again.
+
+        Returns:
+            path of the pixel file
+        """
+        from . import pixels
+
+        timestamp = self._pixels_timestamp(out_path)
+        path = pixels.pixels_path(out_path, timestamp)
+        identity = pixels.identity(out_path)
+        header = pixels.read_header(path)
+        if header is None or header.get('identity') != identity:
+            sha256 = self._read_metadata(out_path).get('sha256')
+            previous = pixels.find(out_path, sha256) if sha256 else None
+            if previous is not None:
+                pixels.retag(previous, path, timestamp, identity)
+                self.logger.debug(f'renamed {previous} to {path}')
+            else:
+                pixels.write(out_path, path, timestamp, sha256)
+                self.logger.debug(f'decoded {out_path} into {path}')
+        pixels.evict(out_path, path)
+        return path
+
+    def _detect_change(self, out_path, stats, pixels_path=None):
+        """
+        Set ``stats.change`` to the score of the new map ``out_path`` by the
+        ``change_detector``, using its pixel file if it is given, and
+        ``stats.significant``
+        """
+        from . import pixels
+
+        decoded = pixels.load(pixels_path) if pixels_path else None
+        stats.change = self.change_detector.score(out_path, decoded)
+        stats.significant = self.change_detector.significant(stats.change)
+        if stats.significant:
+            self.logger.info(f'{out_path} changed by {stats.change:.1%}')
+        else:
+            self.logger.info(
+                f'{out_path} changed by {stats.change:.1%}, below '
+                f'{self.change_detector.threshold:.1%}: insignificant'
+            )
+
+    def decoded(self, outdir, outfile):
+        """
+        Return the pixels of the downloaded map as read-only ``numpy.memmap``
+        of shape ``(height, width[, bands])`` (requires numpy and Pillow)
+
+        The map is decoded only once per upstream version into a pixel file
+        (with ``pixel_cache`` already by ``download``), all later calls, also
+        by other processes, map that file. The pixels of older versions are
+        removed when a new version is decoded, arrays which still map them
+        stay valid.
+
+        Args:
+            * outdir:
+                Directory the image is saved in
+            * outfile:
+                Filename of the image
+        """
+        from . import pixels
+
+        out_path = outdir / Path(outfile)
+        try:
+            path = pixels.pixels_path(out_path,
+                                      self._pixels_timestamp(out_path))
+            header = pixels.read_header(path)
+            if (header is not None and
+                    header.get('identity') == pixels.identity(out_path)):
+                return pixels.load(path)
+        except OSError:
+            pass
+
+        lock = self._lock(out_path)
+        lock.acquire()
+        try:
+            path = self._update_pixels(out_path)
+            return pixels.load(path)
+        finally:
+            lock.release()
+
+    def derive(self, source, outdir, outfile, force):
+        """
+        Create the cloud map by scaling an already downloaded map of another
+        resolution with ``kernel`` and applying the ``postprocess``
+        pipeline instead of downloading it (requires numpy and Pillow).
+        ``.png`` files are written as PNG, which is needed for an alpha
+        channel, all other files as JPEG.
+
+        Args:
+            * source:
+                Path of the downloaded map of the larger resolution
+            * outdir:
+                Directory the image should be saved in
+            * outfile:
+                Filename of the image
+            * force:
+                Force recreating the image
+
+        Returns:
+            ``True`` if a new image was written, ``False`` if the existing
+            image was already derived from the current source image or from
+            one with the same content
+        """
+        from . import resample
+
+        Path(outdir).mkdir(parents=True, exist_ok=True)
+
+        source = Path(source)
+        out_path = outdir / Path(outfile)
+        metadata = self._read_metadata(source)
+
+        source_sha256 = metadata.pop('sha256', None)
+        copy = (metadata.get('url') == self._url and
+                self._source == self._size and self.postprocess is None)
+        metadata['kernel'] = None if copy else self.kernel
+        metadata['postprocess'] = (None if self.postprocess is None
+                                   else str(self.postprocess))
+        if source_sha256:
+            metadata['source-sha256'] = source_sha256
+        image_format = 'PNG' if out_path.suffix.lower() == '.png' else 'JPEG'
+        if (image_format == 'JPEG' and self.postprocess is not None and
+                self.postprocess.alpha):
+            raise ValueError(f'{out_path}: an alpha channel needs a .png '
+                             f'file')
+
+        if not force and out_path.exists() and metadata.get('url'):
+            current = self._read_metadata(out_path)
+            # the own hash of the image is the only key not derived from
+            # the source and the settings
+            keys = (set(current) | set(metadata)) - {'sha256'}
+            if all(current.get(key) == metadata.get(key) for key in keys):
+                self.logger.info(f'{out_path} is new enough')
+                return False
+            if source_sha256 and all(
+                    current.get(key) == metadata.get(key) for key in keys
+                    if key not in ('etag', 'last-modified')):
+                # a new upstream version with the content of the last one
+                self._keep_content(out_path, dict(current, **metadata))
+                return False
+
+        part_file = out_path.with_name(out_path.name + '.part')
+        try:
+            if copy:
+                shutil.copyfile(source, part_file)
+            else:
+                with open(part_file, 'wb') as f:
+                    resample.save_scaled(source, f, *self._size,
+                                         kernel=self.kernel,
+                                         pipeline=self.postprocess,
+                                         format=image_format)
+            metadata['sha256'] = _hash_file(part_file).hexdigest()
+            mtime = source.stat().st_mtime
+            os.utime(part_file, (mtime, mtime))
+            os.replace(part_file, out_path)
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        self._write_metadata(out_path, metadata)
+        if metadata.get('last-modified'):
+            self._record_history(
+                out_path, http_date_timestamp(metadata['last-modified'])
+            )
+        self.logger.debug(f'derived {out_path} from {source}')
+        return True
+
+    def _rendered_stats(self, out_path):
+        """
+        Return the ``DownloadStats`` of the map ``out_path`` rendered from
+        its source map, after notifying ``progress``, and the listener of
+        the source download, which passes on the progress of the transfer
+        """
+        stats = DownloadStats(self._url, out_path)
+        if self.progress is None:
+            return stats, None
+        self.progress.started(stats)
+        return stats, SourceProgress(self.progress, stats)
+
+    def _report_result(self, stats):
+        """
+        Notify ``progress`` about the result of a successful download
+        """
+        if self.progress is not None:
+            if stats.updated:
+                self.progress.finished(stats)
+            else:
+                self.progress.not_modified(stats)
+
+    def _report_error(self, stats, error):
+        stats.error = str(error) or repr(error)
+        if self.progress is not None:
+            self.progress.error(stats, error)
+
+    def _derive_locked(self, source, outdir, outfile, force):
+        """
+        ``derive`` while holding the lock of the derived image, which is
+        also decoded with ``pixel_cache``
+        """
+        out_path = outdir / Path(outfile)
+        lock = self._lock(out_path)
+        lock.acquire()
+        try:
+            return self._derive_decoded(source, outdir, outfile, force)
+        finally:
+            lock.release()
+
+    def _derive_reported(self, source_stats, source, outdir, outfile,
+                         force):
+        """
+        ``_derive_locked`` reported like a download of the derived map,
+        which gets the change score of the ``source`` map downloaded with
+        ``source_stats``
+
+        Returns:
+            ``DownloadStats`` of the derived map
+        """
+        stats, _ = self._rendered_stats(outdir / Path(outfile))
+        try:
+            with stats.phase('render'):
+                stats.updated = self._derive_locked(source, outdir, outfile,
+                                                    force)
+            if stats.updated:
+                stats.change = source_stats.change
+                stats.significant = source_stats.significant
+        except Exception as e:
+            self._report_error(stats, e)
+            raise
+        finally:
+            self._report(stats)
+        self._report_result(stats)
+        return stats
+
+    def _derive_decoded(self, source, outdir, outfile, force):
+        """
+        ``derive`` and decode the derived image with ``pixel_cache``
+        """
+        updated = self.derive(source, outdir, outfile, force)
+        if self.pixel_cache:
+            self._update_pixels(outdir / Path(outfile))
+        return updated
+
+
+class CloudMap(CloudMapBase):
+
+    """
+    Class to download and process the could map from clouds.matteason.co.uk
+    """
+
+    min_segment_size = 1024 * 1024
+    transient_errors = (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout,
+                        RangeError)
+
+    def __init__(self, outwidth, outheight, session=None, segments=1,
+                 cache=None, base_url=None, mirrors=None, retry=None,
+                 breaker=None, stats_file=None, metrics=None, progress=None,
+                 kernel=None, postprocess=None, pixel_cache=False,
+                 change_detector=None):
+        """
+        Args:
+            * outwidth:
+                width of the downloaded cloud map
+            * outheight:
+                height of the downloaded cloud map
+            * session:
+                ``requests.Session`` used for all requests, a new pooled
+                session is created by ``create_session`` if not given
+            * segments:
+                number of byte ranges downloaded concurrently, if the
+                server supports range requests and the image has at least
+                ``min_segment_size`` bytes per segment
+            * cache:
+                ``MapCache`` the downloaded images are stored in and missing
+                or forcefully reloaded images are restored from
+            * base_url:
+                server the maps are downloaded from, see ``CloudMapBase``
+            * mirrors:
+                ``MirrorPool`` of servers the maps are downloaded from
+                instead of ``base_url``, which then only identifies the
+                image in the metadata and cache
+            * retry:
+                ``RetryPolicy`` of failed downloads, ``CloudMapBase.retry``
+                if not given
+            * breaker:
+                ``CircuitBreaker`` which stops the downloads while the
+                server is unavailable
+            * stats_file:
+                file the ``DownloadStats`` of every download are appended
+                to as JSON lines
+            * metrics:
+                ``MetricsExporter`` every download is reported to
+            * progress:
+                ``ProgressListener`` notified about the progress of every
+                download
+            * kernel:
+                ``resample.KERNELS`` entry used to scale the map from
+                another resolution, ``CloudMapBase.kernel`` if not given
+            * postprocess:
+                ``postprocess.Pipeline`` applied to the map
+            * pixel_cache:
+                keep the decoded pixels of every new map, see
+                ``CloudMapBase``
+            * change_detector:
+                ``change.ChangeDetector`` scoring every new map
+        """
+
+        super().__init__(outwidth, outheight, base_url)
+        self.session = session if session is not None else create_session()
+        self.segments = segments
+        self.cache = cache
+        self.mirrors = mirrors
+        if retry is not None:
+            self.retry = retry
+        self.breaker = breaker
+        self.stats_file = stats_file
+        self.metrics = metrics
+        self.progress = progress
+        if kernel is not None:
+            self.kernel = kernel
+        self.postprocess = postprocess
+        self.pixel_cache = pixel_cache
+        self.change_detector = change_detector
+
+    @staticmethod
+    def _error_status(error):
+        if (isinstance(error, requests.exceptions.HTTPError) and
+                error.response is not None):
+            return error.response.status_code
+        return None
+
+    def _source_map(self, progress=None):
+        """
+        Return a ``CloudMap`` of the resolution this map is scaled from,
+        with the same settings. Its downloads are reported as part of
+        this map, so it has no ``stats_file`` and ``metrics``.
+        """
+        return CloudMap(*self._source, session=self.session,
+                        segments=self.segments, cache=self.cache,
+                        base_url=self._base_url, mirrors=self.mirrors,
+                        retry=self.retry, breaker=self.breaker,
+                        progress=progress,
+                        change_detector=self.change_detector)
+
+    def check(self, outdir, outfile):
+        """
+        Check with a conditional HEAD request whether a newer cloud map than
+        the existing image is available
+
+        Args:
+            * outdir:
+                Directory the image is saved in
+            * outfile:
+                Filename of the image
+
+        Returns:
+            ``True`` if the image is missing or a newer one is available
+        """
+        out_path = outdir / Path(outfile)
+        headers = self._request_headers(out_path, False)
+        response = self.session.head(self._url, headers=headers,
+                                     allow_redirects=True,
+                                     timeout=(self.connect_timeout,
+                                              self.read_timeout))
+        self.logger.debug(json.dumps(dict(response.headers), indent=4))
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        return True
 
     def download(self, outdir, outfile, force):
         """
         Download cloud map
 
+        A single conditional GET is sent using the ``ETag`` and
+        ``Last-Modified`` validators stored in ``<outfile>.json``, so an
+        unchanged map costs one round trip and no body bytes.
+
+        Interrupted downloads are kept in ``<outfile>.part`` and continued
+        with a ``Range``/``If-Range`` request, after a delay given by the
+        ``retry`` policy in this call or in a later one. ``read_timeout``
+        limits the time without receiving data, not the total transfer
+        time.
+
+        While the ``breaker`` is open no request is sent and
+        ``CircuitOpenError`` is raised, the existing image is kept.
+
+        Concurrent downloads of the same image, also by other processes,
+        are serialized by the advisory lock ``<outfile>.lock``. A download
+        which had to wait reuses the result of the one it waited for, if
+        that succeeded, instead of sending its own request.
+
+        Maps of resolutions which are not available upstream or with a
+        ``postprocess`` pipeline are rendered from the downloaded source
+        map, see ``CloudMapBase``. With ``pixel_cache`` the new map is
+        decoded while the lock is held, see ``decoded``. The
+        ``change_detector`` sets ``change`` and ``significant`` of the
+        returned stats for a new image, before ``progress`` is notified.
+
+        The time of every phase and the transferred bytes are logged and
+        appended to ``stats_file``, also if the download failed. The
+        ``progress`` listener is notified when the download starts, for
+        the response headers and every chunk, and about its result.
+
         Args:
             * outdir:
                 Directory the image should be saved in
@@ -56,39 +849,581 @@ class CloudMap(object):
                 Filename of the image
             * force:
                 Force reloading the image
+
+        Returns:
+            ``DownloadStats`` of the download, which is true if a new image
+            was written and false if the existing image is still current
         """
 
-        Path(outdir).mkdir(parents=True, exist_ok=True)
+        if self._rendered():
+            stats, progress = self._rendered_stats(outdir / Path(outfile))
+            try:
+                stats.include(self._source_map(progress).download(
+                    outdir, self._source_file(), force
+                ))
+                with stats.phase('render'):
+                    stats.updated = self._derive_locked(
+                        Path(outdir) / self._source_file(), outdir, outfile,
+                        force
+                    )
+            except Exception as e:
+                self._report_error(stats, e)
+                raise
+            finally:
+                self._report(stats)
+            self._report_result(stats)
+            return stats
 
-        response = requests.head(self._url, allow_redirects=True, timeout=10)
-        self.logger.debug(json.dumps(dict(response.headers), indent=4))
+        Path(outdir).mkdir(parents=True, exist_ok=True)
 
         out_path = outdir / Path(outfile)
-        new_time = parser.parse(response.headers['last-modified'])
 
-        if force:
-            self.logger.info(f'{out_path} forcefully downloaded')
-            out_path.unlink(missing_ok=True)
-            self._download_image(self._url, out_path, new_time)
-        elif not out_path.exists():
-            self.logger.debug(f'{out_path} not found')
-            self._download_image(self._url, out_path, new_time)
-        else:
-            old_time = datetime.fromtimestamp(
-                out_path.stat().st_mtime, tz=timezone.utc
-            )
-            if new_time > old_time:
-                out_path.unlink()
+        stats = DownloadStats(self._url, out_path)
+        if self.progress is not None:
+            self.progress.started(stats)
+        previous = self._read_metadata(out_path)
+        since = time.time()
+        lock = self._lock(out_path)
+        with stats.phase('lock wait'):
+            waited = lock.acquire()
+        try:
+            if not (waited and self._coalesce(lock.result(), since, force,
+                                              out_path, previous, stats)):
+                stats.updated = self._fetch_locked(out_path, force, stats)
+            pixels_path = None
+            if self.pixel_cache:
+                with stats.phase('decode'):
+                    pixels_path = self._update_pixels(out_path)
+            if (stats.updated and not stats.coalesced and
+                    self.change_detector is not None):
+                with stats.phase('change'):
+                    self._detect_change(out_path, stats, pixels_path)
+        except Exception as e:
+            self._report_error(stats, e)
+            raise
+        finally:
+            lock.release(self._lock_result(stats))
+            self._report(stats)
+        self._report_result(stats)
+        return stats
+
+    def _fetch_locked(self, out_path, force, stats):
+        headers = self._request_headers(out_path, force)
+
+        cached = None
+        if self.cache is not None and not headers:
+            cached = self.cache.lookup(self._url)
+            if cached is not None:
+                headers = self._validator_headers(cached)
+
+        if self.breaker is None:
+            return self._fetch_with_retries(out_path, headers, cached, stats)
+        self.breaker.allow()
+        try:
+            updated = self._fetch_with_retries(out_path, headers, cached,
+                                               stats)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return updated
+
+    def _fetch_with_retries(self, out_path, headers, cached, stats):
+        retries = self.retry.retries
+        for attempt in range(retries + 1):
+            base_url = self.mirrors.select() if self.mirrors else None
+            stats.attempts += 1
+            try:
+                return self._fetch(out_path, headers, cached, base_url,
+                                   stats)
+            except requests.exceptions.RequestException as e:
+                if base_url is not None:
+                    self.mirrors.record_failure(base_url)
+                elif not self._is_transient(e):
+                    raise
+                if attempt == retries:
+                    raise
+                delay = self.retry.delay(attempt)
+                self.logger.warning(
+                    f'{base_url or self._url}: {e}, '
+                    f'retry {attempt + 1}/{retries} in {delay:.1f} s'
+                )
+                with stats.phase('retry wait'):
+                    time.sleep(delay)
+
+    def _fetch(self, out_path, headers, cached=None, base_url=None,
+               stats=None, segmented=True):
+        """
+        Send the (conditional) GET to ``base_url`` (or the configured URL)
+        and store the image, continuing a partial download left in
+        ``<outfile>.part`` if its validator still matches. If the validators
+        of the ``cached`` image were sent and it is still current, it is
+        restored from the cache. The timing is added to ``stats``.
+
+        The image is downloaded in ``segments`` if ``segmented`` is set and
+        the server supports ranges. If it does not serve the requested
+        ranges after all, the image is fetched again as a single stream.
+        """
+        stats = stats if stats is not None else DownloadStats()
+        url = self._url if base_url is None else base_url + self._path
+        part_file = out_path.with_name(out_path.name + '.part')
+        offset, range_headers = self._resume_headers(part_file)
+        request_headers = {**headers, **range_headers}
+        self.logger.debug(f'{url}: request headers: {request_headers}')
+
+        with stats.phase('request'):
+            response = self.session.get(url, headers=request_headers,
+                                        allow_redirects=True,
+                                        timeout=(self.connect_timeout,
+                                                 self.read_timeout),
+                                        stream=True)
+        with response:
+            stats.url = url
+            stats.status = response.status_code
+            self.logger.debug(json.dumps(dict(response.headers), indent=4))
+            if base_url is not None and response.status_code < 500:
+                self.mirrors.record_success(
+                    base_url, response.elapsed.total_seconds()
+                )
+            if self.progress is not None:
+                self.progress.headers(stats, response.headers,
+                                      _total_size(response.headers))
+
+            if response.status_code == 304:
+                self._discard_part(part_file)
+                if cached is not None:
+                    with stats.phase('cache'):
+                        return self._restore_from_cache(cached, out_path,
+                                                        stats)
+                self.logger.info(f'{out_path} is new enough')
+                return False
+
+            if response.status_code == 416:
+                self.logger.debug(f'{part_file} cannot be resumed')
+                self._discard_part(part_file)
+                return self._fetch(out_path, headers, cached, base_url,
+                                   stats, segmented)
+
+            response.raise_for_status()
+            if headers:
                 self.logger.debug(f'{out_path} too old')
-                self._download_image(self._url, out_path, new_time)
+
+            if response.status_code != 206:
+                offset = 0
+            elif _content_range_start(response.headers) != offset:
+                self.logger.debug(f'{part_file} got unexpected range')
+                self._discard_part(part_file)
+                return self._fetch(out_path, headers, cached, base_url,
+                                   stats, segmented)
             else:
-                self.logger.info(f'{out_path} is new enough')
+                self.logger.debug(f'{part_file} resumed at {offset} bytes')
+
+            size = int(response.headers.get('content-length', 0))
+            if (segmented and offset == 0 and self.segments > 1 and
+                    response.headers.get('accept-ranges') == 'bytes' and
+                    size >= self.segments * self.min_segment_size):
+                try:
+                    return self._download_segmented(response, out_path, size,
+                                                    url, stats)
+                except RangeError as e:
+                    self.logger.warning(f'{e}, downloading {out_path} as '
+                                        f'a single stream')
+                    return self._fetch(out_path, headers, cached, base_url,
+                                       stats, segmented=False)
+            return self._download_image(response, out_path, offset, stats)
+
+    def _download_image(self, response, out_file, offset=0, stats=None):
+        """
+        Stream the image in chunks of ``chunk_size`` bytes into a ``.part``
+        file next to ``out_file`` and atomically rename it into place, so
+        readers never see a partially written map. The validators of the
+        response are stored in a metadata file next to the image.
+
+        The ``.part`` file and its validators are kept if the transfer
+        fails, so it can be continued at its current size.
+        """
+        stats = stats if stats is not None else DownloadStats()
+        out_file = Path(out_file)
+        part_file = out_file.with_name(out_file.name + '.part')
+
+        if offset:
+            metadata = self._read_metadata(part_file)
+        else:
+            metadata = self._response_metadata(response.headers)
+            self._write_metadata(part_file, metadata)
+
+        length = offset
+        stats.bytes['resumed'] = offset
+        with stats.phase('hash'):
+            digest = (_hash_file(part_file, offset) if offset
+                      else hashlib.sha256())
+        total = _total_size(response.headers)
+        tic = time.perf_counter()
+        chunks = response.iter_content(chunk_size=self.chunk_size)
+        with open(part_file, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                with stats.phase('download'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with stats.phase('write'):
+                    f.write(chunk)
+                with stats.phase('hash'):
+                    digest.update(chunk)
+                length += len(chunk)
+                stats.add_bytes('received', len(chunk))
+                stats.add_bytes('written', len(chunk))
+                if self.progress is not None:
+                    self._report_chunk(stats, length, total, length - offset,
+                                       tic)
+        self.logger.debug(f'{response.url}: length: {length}')
+        return self._finish_download(part_file, out_file, metadata, digest,
+                                     stats)
+
+    def _download_segmented(self, response, out_file, size, url,
+                            stats=None):
+        """
+        Download the image as ``segments`` byte ranges in parallel into a
+        preallocated ``.part`` file and atomically rename it into place
+
+        The first range is read from ``response``, the others are requested
+        with ``Range``/``If-Range`` over the pooled session. A failed
+        segmented download is not resumed, its ``.part`` file is removed.
+        """
+        stats = stats if stats is not None else DownloadStats()
+        part_file = out_file.with_name(out_file.name + '.part')
+        self._discard_part(part_file)
+        metadata = self._response_metadata(response.headers)
+        validator = _range_validator(metadata)
+
+        segment_size = -(-size // self.segments)
+        ranges = [
+            (start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)
+        ]
+        self.logger.debug(f'{url}: {len(ranges)} segments of '
+                          f'{segment_size} bytes')
+
+        stop = threading.Event()
+        tic = time.perf_counter()
+        if self.progress is not None:
+            written = stats.bytes['written']
+
+            def on_chunk():
+                received = stats.bytes['written'] - written
+                self._report_chunk(stats, received, size, received, tic)
+        else:
+            on_chunk = None
+        try:
+            with open(part_file, 'wb') as f:
+                f.truncate(size)
+            with ThreadPoolExecutor(max_workers=len(ranges) - 1) as executor:
+                futures = [
+                    executor.submit(self._fetch_segment, part_file, url,
+                                    start, end, validator, stop, stats,
+                                    on_chunk)
+                    for start, end in ranges[1:]
+                ]
+                try:
+                    self._write_segment(part_file, response, *ranges[0],
+                                        stop, stats, on_chunk)
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    raise
+                finally:
+                    response.close()
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+        finally:
+            stats.add_time('download', time.perf_counter() - tic)
+        return self._finish_download(part_file, out_file, metadata,
+                                     stats=stats)
+
+    def _fetch_segment(self, part_file, url, start, end, validator, stop,
+                       stats, on_chunk=None):
+        headers = {'Range': f'bytes={start}-{end}'}
+        if validator:
+            headers['If-Range'] = validator
+        with self.session.get(url, headers=headers,
+                              allow_redirects=True,
+                              timeout=(self.connect_timeout,
+                                       self.read_timeout),
+                              stream=True) as response:
+            response.raise_for_status()
+            if (response.status_code != 206 or
+                    _content_range_start(response.headers) != start):
+                raise RangeError(
+                    f'{url}: bytes {start}-{end} not served'
+                )
+            self._write_segment(part_file, response, start, end, stop,
+                                stats, on_chunk)
+
+    def _write_segment(self, part_file, response, start, end, stop, stats,
+                       on_chunk=None):
+        """
+        Write the bytes ``start`` to ``end`` (inclusive) read from
+        ``response`` at their position in ``part_file``, calling
+        ``on_chunk`` after every chunk
+        """
+        remaining = end - start + 1
+        with open(part_file, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                if stop.is_set():
+                    return
+                f.write(chunk[:remaining])
+                stats.add_bytes('received', len(chunk))
+                stats.add_bytes('written', min(len(chunk), remaining))
+                remaining -= len(chunk)
+                if on_chunk is not None:
+                    on_chunk()
+                if remaining <= 0:
+                    return
+        raise requests.exceptions.ChunkedEncodingError(
+            f'{response.url}: bytes {start}-{end} incomplete'
+        )
+
+
+def http_date_timestamp(value):
+    """
+    Return the POSIX timestamp of the HTTP date ``value``
+    """
+    d = parsedate_to_datetime(value)
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return d.timestamp()
+
+
+def history_path(out_path):
+    """
+    Return the path of the update history of the image ``out_path``
+    """
+    out_path = Path(out_path)
+    return out_path.with_name(out_path.name + '.history')
+
+
+def read_history(path):
+    """
+    Read an update history written by ``CloudMap.download``
+
+    Returns:
+        list of ``(last_modified, seen)`` POSIX timestamps of the downloaded
+        images, oldest first
+    """
+    entries = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries.append((entry['last-modified'], entry['seen']))
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except OSError:
+        pass
+    return entries
+
+
+def _hash_file(path, size=None, chunk_size=1024 * 1024):
+    """
+    Return the ``hashlib.sha256`` of the first ``size`` bytes of ``path``
+    (of the whole file if ``size`` is ``None``)
+    """
+    digest = hashlib.sha256()
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None
+                           else min(chunk_size, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
+
+
+def _total_size(headers):
+    """
+    Return the size of the complete image from the ``Content-Range`` or
+    ``Content-Length`` header, or ``None`` if it is unknown
+    """
+    unit, _, byte_range = headers.get('content-range', '').partition(' ')
+    size = byte_range.rpartition('/')[2]
+    if unit == 'bytes' and size.isdigit():
+        return int(size)
+    length = headers.get('content-length', '')
+    return int(length) if length.isdigit() else None
+
+
+def _range_validator(metadata):
+    """
+    Return the validator usable in ``If-Range``, which must not be a weak
+    ``ETag``
+    """
+    etag = metadata.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return metadata.get('last-modified')
+
+
+def _content_range_start(headers):
+    """
+    Return the first byte position of a ``Content-Range: bytes a-b/n``
+    header, or ``None`` if it is missing or malformed
+    """
+    unit, _, byte_range = headers.get('content-range', '').partition(' ')
+    start = byte_range.partition('-')[0]
+    if unit != 'bytes' or not start.isdigit():
+        return None
+    return int(start)
+
+
+def download_all(targets, force=False, max_workers=4, session=None,
+                 derive=False, segments=1, cache=None, base_url=None,
+                 mirrors=None, retry=None, breaker=None, stats_file=None,
+                 metrics=None, progress=None, kernel=None, postprocess=None,
+                 pixel_cache=False, change_detector=None):
+    """
+    Download several cloud maps concurrently on a bounded thread pool,
+    sharing one connection pool
+
+    Args:
+        * targets:
+            list of ``(outwidth, outheight, outdir, outfile)`` tuples
+        * force:
+            Force reloading the images
+        * max_workers:
+            maximum number of concurrent requests
+        * session:
+            ``requests.Session`` shared by all downloads, a new pooled
+            session is created by ``create_session`` if not given
+        * derive:
+            only download the largest resolution and derive the other
+            ones from it locally (requires numpy and Pillow)
+        * segments:
+            number of byte ranges each large image is downloaded in
+        * cache:
+            ``MapCache`` shared by all downloads
+        * base_url:
+            server the maps are downloaded from, see ``CloudMapBase``
+        * mirrors:
+            ``MirrorPool`` the maps are downloaded from, it is probed first
+            if that has not happened yet
+        * retry:
+            ``RetryPolicy`` of failed downloads
+        * breaker:
+            ``CircuitBreaker`` shared by all downloads, which count as one
+            run of the breaker
+        * stats_file:
+            file the ``DownloadStats`` of every download are appended to
+        * metrics:
+            ``MetricsExporter`` every download is reported to
+        * progress:
+            ``ProgressListener`` notified about all downloads, its
+            callbacks are called from several threads
+        * kernel:
+            ``resample.KERNELS`` entry used to scale maps from another
+            resolution
+        * postprocess:
+            ``postprocess.Pipeline`` applied to all maps
+        * pixel_cache:
+            keep the decoded pixels of all maps, see ``CloudMapBase``
+        * change_detector:
+            ``change.ChangeDetector`` scoring the downloaded maps
+
+    Returns:
+        list with the ``DownloadStats`` of every target
+    """
+    logger = logging.getLogger('create_map_logger')
+
+    run = breaker.run() if breaker is not None else nullcontext()
+    with run:
+        if session is None:
+            session = create_session(pool_maxsize=max_workers * segments)
+        if mirrors is not None and not mirrors.probed:
+            mirrors.probe(session)
+        cloud_maps = [
+            CloudMap(outwidth, outheight, session=session, segments=segments,
+                     cache=cache, base_url=base_url, mirrors=mirrors,
+                     retry=retry, breaker=breaker, stats_file=stats_file,
+                     metrics=metrics, progress=progress, kernel=kernel,
+                     postprocess=postprocess, pixel_cache=pixel_cache,
+                     change_detector=change_detector)
+            for outwidth, outheight, _, _ in targets
+        ]
+        paths = [Path(outdir) / outfile for _, _, outdir, outfile in targets]
+
+        if not derive:
+            return _run_concurrently(
+                [(cloud_map.download, outdir, outfile, force)
+                 for cloud_map, (_, _, outdir, outfile)
+                 in zip(cloud_maps, targets)],
+                paths, max_workers
+            )
+
+        largest = max(range(len(targets)),
+                      key=lambda i: targets[i][0] * targets[i][1])
+        others = [i for i in range(len(targets)) if i != largest]
+        _, _, outdir, outfile = targets[largest]
+
+        results = [None] * len(targets)
+        tic = timeit.default_timer()
+        results[largest] = cloud_maps[largest].download(outdir, outfile, force)
+        download_time = timeit.default_timer() - tic
+
+        tic = timeit.default_timer()
+        source = cloud_maps[largest]._raw_path(outdir, outfile)
+        derived = _run_concurrently(
+            [(cloud_maps[i]._derive_reported, results[largest], source,
+              targets[i][2], targets[i][3], force)
+             for i in others],
+            [paths[i] for i in others], max_workers
+        )
+        derive_time = timeit.default_timer() - tic
+        for i, result in zip(others, derived):
+            results[i] = result
+
+        saved = sum(
+            paths[i].stat().st_size for i, result in zip(others, derived)
+            if result
+        )
+        if saved:
+            message = (
+                f'derived maps in {derive_time:.1f} s, '
+                f'saved downloading {saved} bytes'
+            )
+            if results[largest]:
+                rate = paths[largest].stat().st_size / download_time
+                message += f' (~{saved / rate:.1f} s at {rate / 1e6:.1f} MB/s)'
+            logger.info(message)
+        return results
+
+
+def _run_concurrently(calls, paths, max_workers):
+    """
+    Run ``(function, *args)`` calls on a thread pool, log the failures and
+    raise the first one after all calls have finished
+    """
+    logger = logging.getLogger('create_map_logger')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(*call) for call in calls]
 
-    def _download_image(self, t, out_file, d):
-        r = requests.get(t, allow_redirects=True, timeout=20)
-        self.logger.debug(f'{t}: length: {len(r.content)}')
-        with open(out_file, 'wb') as f:
-            f.write(r.content)
-        os.utime(out_file, (d.timestamp(), d.timestamp()))
-        r.close()
-        self.logger.debug(f'downloaded {out_file}')
+    results = []
+    error = None
+    for path, future in zip(paths, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f'{path}: failed: {e}')
+            results.append(None)
+            error = error or e
+    if error is not None:
+        raise error
+    return results
@@ -0,0 +1,120 @@
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class FileLock(object):
+
+    """
+    Advisory lock on a file, which serializes the processes (and threads)
+    writing the same image
+
+    The holder stores the result of its work in the lock file when it
+    releases the lock, so the next holder can reuse it instead of doing the
+    same work again.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, path):
+        """
+        Args:
+            * path:
+                lock file, it is created if it does not exist and kept
+                afterwards
+        """
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """
+        Wait until the lock is free and take it
+
+        Returns:
+            ``True`` if another holder had to be waited for
+        """
+        if self.try_acquire():
+            return False
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        else:
+            while not _try_lock(self._file):
+                time.sleep(self.poll_interval)
+        return True
+
+    def try_acquire(self):
+        """
+        Take the lock if it is free, without waiting
+
+        Returns:
+            ``True`` if the lock was taken, otherwise the lock file is kept
+            open for the next try until ``close``
+        """
+        if self._file is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._file = os.fdopen(fd, 'r+')
+        return _try_lock(self._file)
+
+    def close(self):
+        """
+        Close the lock file after ``try_acquire`` failed, without taking the
+        lock
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def result(self):
+        """
+        Return the result stored by the previous holder, ``{}`` if there is
+        none
+        """
+        self._file.seek(0)
+        try:
+            return json.loads(self._file.read() or '{}')
+        except ValueError:
+            return {}
+
+    def release(self, result=None):
+        """
+        Store the ``result`` dictionary for the next holder, if it is given,
+        and release the lock
+        """
+        try:
+            if result is not None:
+                self._file.seek(0)
+                self._file.truncate()
+                self._file.write(json.dumps(result))
+                self._file.flush()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            self._file.close()
+            self._file = None
+
+
+def _try_lock(f):
+    """
+    Take the lock of the open file ``f`` without waiting
+
+    Returns:
+        ``True`` if the lock was taken
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
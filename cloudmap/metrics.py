@@ -0,0 +1,250 @@
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+import time
+
+
+class MetricsExporter(object):
+
+    """
+    Freshness and fetch performance of the cloud maps in the Prometheus
+    text format, e.g. for the textfile collector of node_exporter
+
+    Every ``DownloadStats`` passed to ``observe`` is added to counters and
+    a histogram per resolution. These are kept in ``<path>.json`` if a
+    ``path`` is given, so they keep counting across runs started by cron.
+    The age of the maps is read from their metadata whenever the metrics
+    are rendered.
+    """
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, targets, path=None):
+        """
+        Args:
+            * targets:
+                list of ``(outwidth, outheight, outdir, outfile)`` tuples
+                of the maps to report
+            * path:
+                textfile written by ``write``
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.targets = targets
+        self.path = Path(path) if path is not None else None
+        self._lock = threading.Lock()
+        self._state = self._read_state()
+        self._last_run = None
+
+    def _state_path(self):
+        return self.path.with_name(self.path.name + '.json')
+
+    def _read_state(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self._state_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def observe(self, resolution, stats):
+        """
+        Count the download of the map with the ``(width, height)``
+        ``resolution`` described by ``stats``
+        """
+        key = '{}x{}'.format(*resolution)
+        if stats.error is not None:
+            result = 'failed'
+        elif stats.updated:
+            result = 'updated'
+        else:
+            result = 'not_modified'
+        duration = stats.seconds.get('total', 0.0)
+
+        with self._lock:
+            entry = self._state.setdefault(key, {
+                'fetches': {'updated': 0, 'not_modified': 0, 'failed': 0},
+                'retries': 0,
+                'bytes': 0,
+                'buckets': [0] * len(self.buckets),
+                'count': 0,
+                'sum': 0.0,
+                'last_success': None,
+            })
+            entry['fetches'][result] += 1
+            entry['retries'] += max(stats.attempts - 1, 0)
+            entry['bytes'] += stats.bytes['received']
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    entry['buckets'][i] += 1
+            entry['count'] += 1
+            entry['sum'] += duration
+            if result != 'failed':
+                entry['last_success'] = time.time()
+            self._last_run = time.time()
+
+    def render(self, now=None):
+        """
+        Return all metrics in the Prometheus text format
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = json.loads(json.dumps(self._state))
+            last_run = self._last_run
+
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            if not samples:
+                return
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                value = _format(value)
+                lines.append(f'{name}{suffix}{{{label_text}}} {value}'
+                             if label_text else f'{name}{suffix} {value}')
+
+        modified = []
+        age = []
+        for width, height, outdir, outfile in self.targets:
+            labels = [('resolution', f'{width}x{height}')]
+            timestamp = _last_modified(Path(outdir) / outfile)
+            if timestamp is not None:
+                modified.append(('', labels, timestamp))
+                age.append(('', labels, now - timestamp))
+        family('cloudmap_upstream_last_modified_timestamp_seconds', 'gauge',
+               'Last-Modified time of the local map', modified)
+        family('cloudmap_map_age_seconds', 'gauge',
+               'Time since the local map was published upstream', age)
+
+        family('cloudmap_last_success_timestamp_seconds', 'gauge',
+               'Time of the last successful fetch',
+               [('', [('resolution', key)], entry['last_success'])
+                for key, entry in state.items()
+                if entry['last_success'] is not None])
+        family('cloudmap_fetches_total', 'counter',
+               'Fetches by result (updated, not_modified, failed)',
+               [('', [('resolution', key), ('result', result)], count)
+                for key, entry in state.items()
+                for result, count in entry['fetches'].items()])
+        family('cloudmap_not_modified_ratio', 'gauge',
+               'Share of the fetches answered with 304 Not Modified',
+               [('', [('resolution', key)],
+                 entry['fetches']['not_modified'] / entry['count'])
+                for key, entry in state.items() if entry['count']])
+        family('cloudmap_retries_total', 'counter',
+               'Retried fetch attempts',
+               [('', [('resolution', key)], entry['retries'])
+                for key, entry in state.items()])
+        family('cloudmap_received_bytes_total', 'counter',
+               'Body bytes received',
+               [('', [('resolution', key)], entry['bytes'])
+                for key, entry in state.items()])
+
+        histogram = []
+        for key, entry in state.items():
+            labels = [('resolution', key)]
+            for bound, count in zip(self.buckets, entry['buckets']):
+                histogram.append(('_bucket', labels + [('le', f'{bound:g}')],
+                                  count))
+            histogram.append(('_bucket', labels + [('le', '+Inf')],
+                              entry['count']))
+            histogram.append(('_sum', labels, entry['sum']))
+            histogram.append(('_count', labels, entry['count']))
+        family('cloudmap_fetch_duration_seconds', 'histogram',
+               'Duration of the fetches including retries', histogram)
+
+        if last_run is not None:
+            family('cloudmap_last_run_timestamp_seconds', 'gauge',
+                   'Time of the last run of create_map',
+                   [('', [], last_run)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Atomically replace the textfile by the current metrics and store the
+        counters for the next run
+        """
+        if self.path is None:
+            return
+        text = self.render()
+        with self._lock:
+            state = json.dumps(self._state, indent=4)
+        for path, content in ((self._state_path(), state),
+                              (self.path, text)):
+            tmp_path = path.with_name(path.name + '.part')
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        self.logger.debug(f'metrics written to {self.path}')
+
+
+class MetricsServer(object):
+
+    """
+    HTTP server answering ``GET /metrics`` with the current metrics of a
+    ``MetricsExporter``
+    """
+
+    def __init__(self, exporter, address=('', 9101)):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.logger = logging.getLogger('create_map_logger')
+        metrics = exporter
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                logging.getLogger('create_map_logger').debug(
+                    f'{self.address_string()} ' + format % args
+                )
+
+            def do_GET(self):
+                if self.path.partition('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(address, Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        host, port = self.httpd.server_address[:2]
+        self.logger.info(f'serving metrics on http://{host}:{port}/metrics')
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _format(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _last_modified(out_path):
+    """
+    Return the ``Last-Modified`` time of the map ``out_path`` from its
+    metadata, or its modification time, or ``None`` if it is missing
+    """
+    try:
+        with open(out_path.with_name(out_path.name + '.json')) as f:
+            return parsedate_to_datetime(
+                json.load(f)['last-modified']
+            ).timestamp()
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    try:
+        return out_path.stat().st_mtime
+    except OSError:
+        return None
@@ -0,0 +1,211 @@
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import json
+import logging
+import mmap
+import re
+import sys
+import threading
+
+from .live_cloud_maps import CloudMapBase
+
+
+class MirrorServer(object):
+
+    """
+    HTTP server for the cloud maps downloaded by this node, so other nodes
+    can use it as ``base_url`` instead of the upstream server
+
+    The maps are served from memory maps of the downloaded files under the
+    upstream URLs ``/images/<width>x<height>/clouds.jpg``, with the upstream
+    ``ETag`` and ``Last-Modified`` validators, conditional requests (304)
+    and single byte ranges.
+    """
+
+    def __init__(self, targets, address=('', 8080)):
+        """
+        Args:
+            * targets:
+                list of ``(outwidth, outheight, outdir, outfile)`` tuples of
+                the served maps
+            * address:
+                ``(host, port)`` the server listens on
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.targets = targets
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+        mirror = self
+
+        class Handler(_MirrorHandler):
+            server_mirror = mirror
+
+        self.httpd = _MirrorHTTPServer(address, Handler)
+
+    def reload(self):
+        """
+        Map the current version of every downloaded map into memory
+        """
+        for outwidth, outheight, outdir, outfile in self.targets:
+            out_path = Path(outdir) / outfile
+            key = f'/images/{outwidth}x{outheight}/clouds.jpg'
+            try:
+                with open(out_path.with_name(out_path.name + '.json')) as f:
+                    metadata = json.load(f)
+                current = self.get(key)
+                if current is not None and current[1] == metadata:
+                    continue
+                with open(out_path, 'rb') as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as e:
+                self.logger.debug(f'{out_path} not served: {e}')
+                continue
+
+            with self._lock:
+                self._maps[key] = (data, metadata)
+            self.logger.debug(f'serving {out_path} as {key}')
+
+    def get(self, path):
+        """
+        Return ``(data, metadata)`` of the map served at ``path`` or ``None``
+        """
+        with self._lock:
+            return self._maps.get(path)
+
+    def start(self):
+        """
+        Serve the maps in a background thread
+        """
+        self.reload()
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        host, port = self.httpd.server_address[:2]
+        self.logger.info(f'serving cloud maps on http://{host}:{port}/')
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _MirrorHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing the connection early, e.g. after the first
+        # segment of a segmented download, are expected
+        logging.getLogger('create_map_logger').debug(
+            f'{client_address}: {sys.exc_info()[1]!r}'
+        )
+
+
+class _MirrorHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_mirror = None
+
+    def log_message(self, format, *args):
+        logging.getLogger('create_map_logger').debug(
+            f'{self.address_string()} ' + format % args
+        )
+
+    def do_HEAD(self):
+        self._send_map(body=False)
+
+    def do_GET(self):
+        self._send_map(body=True)
+
+    def _send_map(self, body):
+        served = self.server_mirror.get(self.path.partition('?')[0])
+        if served is None:
+            self.send_error(404)
+            return
+        data, metadata = served
+
+        if self._not_modified(metadata):
+            self.send_response(304)
+            self._send_validators(metadata)
+            self.end_headers()
+            return
+
+        size = len(data)
+        start, end = 0, size - 1
+        byte_range = self._byte_range(metadata, size)
+        if byte_range is not None:
+            start, end = byte_range
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self._send_validators(metadata)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if body:
+            with memoryview(data) as view:
+                self.wfile.write(view[start:end + 1])
+
+    def _send_validators(self, metadata):
+        if metadata.get('etag'):
+            self.send_header('ETag', metadata['etag'])
+        if metadata.get('last-modified'):
+            self.send_header('Last-Modified', metadata['last-modified'])
+
+    def _not_modified(self, metadata):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or metadata.get('etag') in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and metadata.get('last-modified'):
+            try:
+                return (parsedate_to_datetime(metadata['last-modified']) <=
+                        parsedate_to_datetime(if_modified_since))
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _byte_range(self, metadata, size):
+        """
+        Return the inclusive ``(start, end)`` of a single ``Range`` request,
+        or ``None`` to send the whole map
+        """
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)',
+                             self.headers.get('Range', '').strip())
+        if match is None or match.groups() == ('', ''):
+            return None
+
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range not in (
+                metadata.get('etag'), metadata.get('last-modified')):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            return max(size - int(last), 0), size - 1
+        if last and int(last) < int(first):
+            return None
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def mirror_targets(outdir):
+    """
+    Return the targets for mirroring every resolution available upstream
+    into ``outdir`` as ``clouds_<width>.jpg``
+    """
+    return [
+        (outwidth, outheight, outdir, f'clouds_{outwidth}.jpg')
+        for outwidth, outheight in CloudMapBase.available_resolutions
+    ]
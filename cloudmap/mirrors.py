@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+
+class MirrorPool(object):
+
+    """
+    Track the latency and error rate of several servers providing the cloud
+    maps and select the fastest healthy one
+
+    Mirrors are ranked by their smoothed latency divided by their success
+    rate, i.e. the expected time per successful request, so a failed
+    request moves the next one to another mirror. A mirror is skipped for
+    ``cooldown`` seconds after ``max_failures`` consecutive failures.
+    Mirrors with equal rank keep their configured order, so internal caches
+    listed first are preferred.
+    """
+
+    smoothing = 0.3
+    max_failures = 2
+    cooldown = 60
+
+    def __init__(self, base_urls):
+        """
+        Args:
+            * base_urls:
+                list of servers providing ``/images/<width>x<height>/
+                clouds.jpg``, in order of preference
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.base_urls = [url.rstrip('/') for url in base_urls]
+        self.probed = False
+        self._lock = threading.Lock()
+        self._stats = {
+            url: {'latency': None, 'error_rate': 0.0, 'failures': 0,
+                  'down_until': 0.0}
+            for url in self.base_urls
+        }
+
+    def probe(self, session, timeout=5):
+        """
+        Measure the latency of all mirrors concurrently with a HEAD request
+        for the smallest map
+
+        Args:
+            * session:
+                ``requests.Session`` used for the requests
+            * timeout:
+                timeout of each probe in seconds
+        """
+        def probe_one(base_url):
+            url = f'{base_url}/images/1024x512/clouds.jpg'
+            try:
+                response = session.head(url, allow_redirects=True,
+                                        timeout=timeout)
+                response.raise_for_status()
+            except Exception as e:
+                self.logger.debug(f'probing {base_url} failed: {e}')
+                self.record_failure(base_url)
+            else:
+                self.record_success(base_url,
+                                    response.elapsed.total_seconds())
+
+        with ThreadPoolExecutor(max_workers=len(self.base_urls)) as executor:
+            list(executor.map(probe_one, self.base_urls))
+        self.probed = True
+        self.logger.debug(f'mirrors: {self.status()}')
+
+    def select(self):
+        """
+        Return the fastest healthy mirror, or the one which is down for the
+        shortest time if no mirror is healthy
+        """
+        now = time.time()
+        with self._lock:
+            healthy = [url for url in self.base_urls
+                       if self._stats[url]['down_until'] <= now]
+            if not healthy:
+                return min(self.base_urls,
+                           key=lambda url: self._stats[url]['down_until'])
+            return min(healthy, key=self._latency_key)
+
+    def _latency_key(self, url):
+        stats = self._stats[url]
+        if stats['latency'] is None:
+            return (True, 0.0, self.base_urls.index(url))
+        return (False, stats['latency'] / max(1 - stats['error_rate'], 0.01),
+                self.base_urls.index(url))
+
+    def record_success(self, base_url, latency):
+        """
+        Record a response received from ``base_url`` after ``latency``
+        seconds
+        """
+        with self._lock:
+            stats = self._stats[base_url]
+            if stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += self.smoothing * (latency -
+                                                      stats['latency'])
+            stats['error_rate'] *= 1 - self.smoothing
+            stats['failures'] = 0
+            stats['down_until'] = 0.0
+
+    def record_failure(self, base_url):
+        """
+        Record a failed request to ``base_url``
+        """
+        with self._lock:
+            stats = self._stats[base_url]
+            stats['error_rate'] += self.smoothing * (1 - stats['error_rate'])
+            stats['failures'] += 1
+            if stats['failures'] >= self.max_failures:
+                stats['down_until'] = time.time() + self.cooldown
+                self.logger.warning(
+                    f'{base_url} failed {stats["failures"]} times, skipped '
+                    f'for {self.cooldown} s'
+                )
+
+    def status(self):
+        """
+        Return the latency (ms) and error rate of every mirror as text
+        """
+        with self._lock:
+            return ', '.join(
+                f'{url}: '
+                + ('-' if stats['latency'] is None
+                   else f'{stats["latency"] * 1000:.0f} ms')
+                + f' {stats["error_rate"]:.0%} errors'
+                for url, stats in self._stats.items()
+            )
@@ -0,0 +1,160 @@
+"""
+Decoded pixels of the cloud maps in raw files, which are memory mapped so
+that processes share them through the page cache instead of decoding the
+JPEG again
+"""
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b'CLOUDPIX1\n'
+
+# the pixels start at a page boundary after the header
+HEADER_SIZE = 4096
+
+
+def pixels_path(out_path, last_modified):
+    """
+    Return the path of the pixels of the map ``out_path`` published upstream
+    at the ``last_modified`` timestamp
+    """
+    out_path = Path(out_path)
+    return out_path.with_name(f'.{out_path.name}.{int(last_modified)}.pixels')
+
+
+def identity(path):
+    """
+    Return what identifies the current content of the image file ``path``:
+    replacing it changes the inode, rewriting it the size or modification
+    time
+    """
+    st = os.stat(path)
+    return {'inode': st.st_ino, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _header_bytes(header):
+    data = MAGIC + json.dumps(header).encode() + b'\n'
+    if len(data) > HEADER_SIZE:
+        raise ValueError('pixel file header too large')
+    return data.ljust(HEADER_SIZE, b' ')
+
+
+def write(image_path, path, last_modified, sha256=None, strip_rows=256):
+    """
+    Decode the image ``image_path`` into the pixel file ``path``
+
+    The header is a JSON object with the ``shape``, ``dtype``, Pillow
+    ``mode`` and ``last-modified`` timestamp of the pixels and the
+    ``identity`` and ``sha256`` of the image. The rows are written in
+    strips, so besides the decoded image only one strip is held in memory.
+    The file is replaced atomically.
+    """
+    path = Path(path)
+    with Image.open(image_path) as image:
+        if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        image.load()
+        bands = len(image.getbands())
+        shape = ((image.height, image.width) if bands == 1 else
+                 (image.height, image.width, bands))
+        header = _header_bytes({
+            'shape': shape,
+            'dtype': 'uint8',
+            'mode': image.mode,
+            'last-modified': last_modified,
+            'identity': identity(image_path),
+            'sha256': sha256,
+        })
+
+        part_file = path.with_name(f'{path.name}.{os.getpid()}.part')
+        try:
+            with open(part_file, 'wb') as f:
+                f.write(header)
+                for top in range(0, image.height, strip_rows):
+                    bottom = min(top + strip_rows, image.height)
+                    strip = image.crop((0, top, image.width, bottom))
+                    f.write(np.asarray(strip).tobytes())
+            os.replace(part_file, path)
+        except BaseException:
+            part_file.unlink(missing_ok=True)
+            raise
+
+
+def read_header(path):
+    """
+    Return the header of the pixel file ``path``, ``None`` if it is missing
+    or not a pixel file
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(HEADER_SIZE)
+    except OSError:
+        return None
+    if not data.startswith(MAGIC):
+        return None
+    try:
+        return json.loads(data[len(MAGIC):])
+    except ValueError:
+        return None
+
+
+def load(path):
+    """
+    Return the pixels in ``path`` as read-only ``numpy.memmap`` of shape
+    ``(height, width[, bands])``
+
+    Raises:
+        ``ValueError`` if ``path`` is not a pixel file
+    """
+    header = read_header(path)
+    if header is None:
+        raise ValueError(f'{path} is no pixel file')
+    return np.memmap(path, dtype=header['dtype'], mode='r',
+                     offset=HEADER_SIZE, shape=tuple(header['shape']))
+
+
+def find(out_path, sha256):
+    """
+    Return the pixel file of a version of the map ``out_path`` whose image
+    has the SHA-256 ``sha256``, ``None`` if there is none
+    """
+    out_path = Path(out_path)
+    for path in out_path.parent.glob(f'.{out_path.name}.*.pixels'):
+        header = read_header(path)
+        if header is not None and header.get('sha256') == sha256:
+            return path
+    return None
+
+
+def retag(path, new_path, last_modified, image_identity):
+    """
+    Move the pixel file ``path`` to ``new_path`` for a new version of its
+    image with the same content, which has the ``last_modified`` timestamp
+    and ``image_identity``. The header is rewritten in place, so arrays
+    mapping the file stay valid.
+    """
+    header = read_header(path)
+    header.update({'last-modified': last_modified,
+                   'identity': image_identity})
+    with open(path, 'r+b') as f:
+        f.write(_header_bytes(header))
+    os.replace(path, new_path)
+
+
+def evict(out_path, keep):
+    """
+    Remove the pixel files of older versions of the map ``out_path`` except
+    ``keep``. Processes which mapped them keep their view; files which
+    cannot be removed while mapped (on Windows) are left for the next time.
+    """
+    out_path = Path(out_path)
+    keep = Path(keep)
+    for path in out_path.parent.glob(f'.{out_path.name}.*.pixels'):
+        if path.name != keep.name:
+            try:
+                path.unlink()
+            except OSError:
+                pass
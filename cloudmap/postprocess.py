@@ -0,0 +1,143 @@
+"""
+Point-wise post-processing of cloud maps, e.g. to adapt them to xplanet
+"""
+import numpy as np
+
+
+def _levels(x, low, high):
+    return (x - low) * 255 / (high - low)
+
+
+def _gamma(x, gamma):
+    return 255 * (x / 255) ** (1 / gamma)
+
+
+def _contrast(x, factor):
+    return (x - 128) * factor + 128
+
+
+def _brightness(x, offset):
+    return x + offset
+
+
+def _opacity(x, factor):
+    return x * factor
+
+
+def _invert(x):
+    return 255 - x
+
+
+# operation name: function of the values and the number of its arguments
+OPERATIONS = {
+    'levels': (_levels, 2),
+    'gamma': (_gamma, 1),
+    'contrast': (_contrast, 1),
+    'brightness': (_brightness, 1),
+    'opacity': (_opacity, 1),
+    'invert': (_invert, 0),
+}
+
+
+class Pipeline(object):
+
+    """
+    Sequence of point-wise operations applied to a cloud map
+
+    The pipeline is given as ``name[:arg[:arg]]`` operations separated by
+    spaces, e.g. ``levels:16:240 gamma:1.4 alpha opacity:0.8``:
+
+    * ``levels:LOW:HIGH``: stretch the values ``LOW`` to ``HIGH`` to the
+      full range
+    * ``gamma:G``: gamma correction, values above 1 brighten
+    * ``contrast:C``: scale the distance from mid-gray by ``C``
+    * ``brightness:B``: add ``B``
+    * ``opacity:O``: multiply by ``O``
+    * ``invert``: negate
+    * ``alpha``: add an alpha channel, the operations after it shape the
+      opacity instead of the colors. The alpha channel is the brightness of
+      the map passed through all operations.
+
+    All operations on a channel are fused into one lookup table of 256
+    entries, so applying the pipeline is one table lookup per value.
+    """
+
+    def __init__(self, spec):
+        """
+        Args:
+            * spec:
+                operations as described above
+
+        Raises:
+            ``ValueError`` if an operation is unknown or has wrong arguments
+        """
+        self.spec = ' '.join(spec.split())
+        self.color_ops = []
+        self.alpha_ops = None
+        ops = self.color_ops
+        for item in spec.split():
+            name, *args = item.split(':')
+            if name == 'alpha' and not args and self.alpha_ops is None:
+                self.alpha_ops = ops = []
+                continue
+            if name not in OPERATIONS:
+                raise ValueError(f'unknown post-processing operation {item}')
+            function, count = OPERATIONS[name]
+            if len(args) != count:
+                raise ValueError(f'{name} needs {count} arguments: {item}')
+            args = [float(arg) for arg in args]
+            if ((name == 'levels' and args[0] >= args[1]) or
+                    (name == 'gamma' and args[0] <= 0)):
+                raise ValueError(f'invalid arguments: {item}')
+            ops.append((function, args))
+        self.color_lut = _lookup_table(self.color_ops)
+        self.alpha_lut = (None if self.alpha_ops is None else
+                          _lookup_table(self.color_ops + self.alpha_ops))
+
+    def __str__(self):
+        return self.spec
+
+    @property
+    def alpha(self):
+        """
+        Whether the pipeline adds an alpha channel
+        """
+        return self.alpha_lut is not None
+
+    def mode(self, mode):
+        """
+        Return the image mode of the result for an image of ``mode``
+        (``L`` or ``RGB``)
+        """
+        return mode + 'A' if self.alpha else mode
+
+    def apply(self, strip):
+        """
+        Return the processed ``uint8`` image array ``strip`` of shape
+        ``(rows, width[, bands])``, with an additional alpha band if the
+        pipeline adds one
+        """
+        result = self.color_lut[strip]
+        if not self.alpha:
+            return result
+        if strip.ndim == 2:
+            brightness = strip
+            result = result[..., np.newaxis]
+        else:
+            # ITU-R 601-2 luma like the conversion to "L" of Pillow
+            brightness = ((strip[..., 0] * np.uint32(299) +
+                           strip[..., 1] * np.uint32(587) +
+                           strip[..., 2] * np.uint32(114) + 500) // 1000)
+        alpha = self.alpha_lut[brightness]
+        return np.concatenate([result, alpha[..., np.newaxis]], axis=-1)
+
+
+def _lookup_table(ops):
+    """
+    Return the ``uint8`` table of all 256 values passed through ``ops``, the
+    values are clipped to 0 to 255 after every operation
+    """
+    values = np.arange(256, dtype=np.float64)
+    for function, args in ops:
+        values = np.clip(function(values, *args), 0, 255)
+    return np.rint(values).astype(np.uint8)
@@ -0,0 +1,82 @@
+class DownloadAborted(Exception):
+    """
+    Raised by a ``ProgressListener`` to stop a download, the partial image
+    is kept to be continued later
+    """
+
+
+class ProgressListener(object):
+
+    """
+    Callbacks of ``CloudMap.download`` and ``AsyncCloudMap.download``,
+    which do nothing by default
+
+    Subclasses override the events they are interested in. Every callback
+    gets the ``DownloadStats`` of the download, so far. A callback can raise
+    ``DownloadAborted`` (or any other exception) to stop the download, e.g.
+    if the transfer is too slow; it is not retried and the ``.part`` file of
+    a single stream download is kept to be continued by the next call.
+
+    The callbacks run in the thread (or on the event loop) of the download,
+    ``chunk`` also in the threads of a segmented download, so they should
+    return quickly. Without a listener no callback overhead is added.
+    """
+
+    def started(self, stats):
+        """
+        The download of ``stats.url`` into ``stats.path`` starts
+        """
+
+    def headers(self, stats, headers, total):
+        """
+        The response headers of an attempt were received, ``stats.status``
+        is set and ``total`` is the size of the complete image in bytes if
+        it is known, otherwise ``None``
+        """
+
+    def chunk(self, stats, received, total, rate):
+        """
+        A part of the body was written: ``received`` bytes of the image of
+        ``total`` bytes (``None`` if unknown) are there, including a resumed
+        partial download, and this response was read at ``rate`` bytes per
+        second
+        """
+
+    def finished(self, stats):
+        """
+        A new image was written (downloaded or restored from the cache),
+        with a change detector ``stats.change`` is its score and
+        ``stats.significant`` tells whether it is worth processing
+        """
+
+    def not_modified(self, stats):
+        """
+        The existing image is still current, ``stats.unchanged`` is set if
+        a new upstream version had the same content
+        """
+
+    def error(self, stats, error):
+        """
+        The download failed with the exception ``error`` after all retries,
+        which is raised after this call
+        """
+
+
+class SourceProgress(ProgressListener):
+
+    """
+    Listener of the download of the source map a map is rendered from,
+    which passes the progress of the transfer on to the ``listener`` of the
+    rendered map with its ``stats``
+    """
+
+    def __init__(self, listener, stats):
+        self.listener = listener
+        self.stats = stats
+
+    def headers(self, stats, headers, total):
+        self.stats.status = stats.status
+        self.listener.headers(self.stats, headers, total)
+
+    def chunk(self, stats, received, total, rate):
+        self.listener.chunk(self.stats, received, total, rate)
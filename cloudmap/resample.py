@@ -0,0 +1,364 @@
+"""
+Local scaling of cloud maps, used to derive the smaller resolutions from one
+downloaded image and to create maps of resolutions not available upstream
+"""
+from functools import lru_cache
+import math
+
+import numpy as np
+from PIL import Image
+
+KERNELS = ('nearest', 'box', 'bilinear', 'lanczos')
+
+# output pixels per block of the weights, small blocks skip most zeros
+_BLOCK = 32
+
+
+def _box(x):
+    return ((x > -0.5) & (x <= 0.5)).astype(np.float64)
+
+
+def _triangle(x):
+    return np.maximum(1 - np.abs(x), 0)
+
+
+def _lanczos(x):
+    return np.where(np.abs(x) < 3, np.sinc(x) * np.sinc(x / 3), 0)
+
+
+# filter function and support radius in source pixels (for upscaling)
+_FILTERS = {
+    'box': (_box, 0.5),
+    'bilinear': (_triangle, 1.0),
+    'lanczos': (_lanczos, 3.0),
+}
+
+
+def load_scaled(path, width, height):
+    """
+    Decode an image scaled down to ``width`` x ``height``
+
+    For JPEG images the decoder is asked to scale down while decoding the
+    DCT coefficients (by 1/2, 1/4 or 1/8), the remaining integer factor is
+    removed with ``box_downsample``.
+
+    Args:
+        * path:
+            image file to decode
+        * width:
+            width of the result, must divide the image width
+        * height:
+            height of the result, must divide the image height
+
+    Returns:
+        ``uint8`` array of shape ``(height, width)`` or
+        ``(height, width, bands)``
+    """
+    with Image.open(path) as image:
+        image.draft(image.mode, (width, height))
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        array = np.asarray(image)
+
+    factor_y, rest_y = divmod(array.shape[0], height)
+    factor_x, rest_x = divmod(array.shape[1], width)
+    if rest_x or rest_y or not factor_x or not factor_y:
+        raise ValueError(
+            f'{array.shape[1]}x{array.shape[0]} cannot be downscaled to '
+            f'{width}x{height}'
+        )
+    if factor_x == factor_y == 1:
+        return array
+    return box_downsample(array, factor_x, factor_y)
+
+
+def box_downsample(array, factor_x, factor_y):
+    """
+    Downscale an image array by integer factors by averaging each block of
+    ``factor_x`` x ``factor_y`` pixels
+
+    Args:
+        * array:
+            ``uint8`` array of shape ``(height, width[, bands])``
+        * factor_x:
+            horizontal reduction factor
+        * factor_y:
+            vertical reduction factor
+    """
+    height = array.shape[0] // factor_y
+    width = array.shape[1] // factor_x
+    blocks = array[:height * factor_y, :width * factor_x].reshape(
+        (height, factor_y, width, factor_x) + array.shape[2:]
+    )
+    count = factor_x * factor_y
+    total = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    return ((total + count // 2) // count).astype(np.uint8)
+
+
+@lru_cache(maxsize=32)
+def resample_weights(in_size, out_size, kernel, wrap=False):
+    """
+    Return the source pixels and weights of every output pixel when scaling
+    an axis of ``in_size`` pixels to ``out_size`` pixels with ``kernel``
+
+    The filter is widened by the scale factor when scaling down. With
+    ``wrap`` the axis is periodic (like the longitude of a cloud map),
+    otherwise the weights beyond the edges are dropped. The results are
+    cached, as the same sizes are scaled again and again.
+
+    Returns:
+        tuple of ``int`` index and ``float32`` weight arrays of shape
+        ``(out_size, taps)``, the weights of every row sum up to 1
+    """
+    scale = in_size / out_size
+    centers = (np.arange(out_size) + 0.5) * scale
+    if kernel == 'nearest':
+        index = np.minimum(centers.astype(np.intp), in_size - 1)
+        return index[:, np.newaxis], np.ones((out_size, 1), np.float32)
+
+    function, support = _FILTERS[kernel]
+    filter_scale = max(scale, 1.0)
+    support *= filter_scale
+    taps = 2 * math.ceil(support) + 1
+    first = np.floor(centers - support + 0.5).astype(np.intp)
+    index = first[:, np.newaxis] + np.arange(taps)
+    weights = function((index + 0.5 - centers[:, np.newaxis]) / filter_scale)
+    if wrap:
+        index %= in_size
+    else:
+        outside = (index < 0) | (index >= in_size)
+        weights[outside] = 0
+        index = np.clip(index, 0, in_size - 1)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return index, weights.astype(np.float32)
+
+
+@lru_cache(maxsize=32)
+def _weight_blocks(in_size, out_size, kernel, wrap=False, block=_BLOCK):
+    """
+    Split the weights of ``resample_weights`` into dense matrices of
+    ``block`` output pixels each, so an axis is scaled by matrix products
+
+    Returns:
+        list of ``(start, source, matrix)`` tuples: the output pixels
+        ``start`` to ``start + matrix.shape[1]`` are the product of the
+        source pixels selected by ``source`` (a slice or an index array)
+        and the ``float32`` matrix
+    """
+    index, weights = resample_weights(in_size, out_size, kernel, wrap)
+    blocks = []
+    for start in range(0, out_size, block):
+        block_index = index[start:start + block]
+        first = block_index[0, 0]
+        offsets = (block_index - first) % in_size
+        count = offsets.max() + 1
+        matrix = np.zeros((count, len(block_index)), np.float32)
+        columns = np.broadcast_to(np.arange(len(block_index))[:, np.newaxis],
+                                  offsets.shape)
+        np.add.at(matrix, (offsets, columns), weights[start:start + block])
+        if first + count <= in_size:
+            source = slice(first, first + count)
+        else:
+            source = (first + np.arange(count)) % in_size
+        blocks.append((start, source, matrix))
+    return blocks
+
+
+def resample(array, width, height, kernel='lanczos', strip_rows=128):
+    """
+    Scale an image array to ``width`` x ``height`` with ``kernel``
+
+    The image is scaled vertically and then horizontally, both as products
+    with small dense blocks of the weights, in strips of ``strip_rows``
+    output rows, so the memory needed besides the input and the output
+    stays proportional to the strip size. The image wraps around
+    horizontally.
+
+    Args:
+        * array:
+            ``uint8`` array of shape ``(height, width[, bands])``
+        * width:
+            width of the result
+        * height:
+            height of the result
+        * kernel:
+            one of ``KERNELS``, from the fastest to the sharpest
+        * strip_rows:
+            number of output rows computed at once
+
+    Returns:
+        ``uint8`` array of shape ``(height, width[, bands])``
+    """
+    result = np.empty((height, width) + array.shape[2:], np.uint8)
+    for top, strip in resample_strips(
+            lambda first, last: array[first:last], array.shape,
+            width, height, kernel, strip_rows):
+        result[top:top + len(strip)] = strip
+    return result
+
+
+def resample_strips(read_rows, shape, width, height, kernel='lanczos',
+                    strip_rows=128):
+    """
+    Scale an image to ``width`` x ``height`` with ``kernel`` strip by strip,
+    like ``resample``, reading only the source rows needed for each strip
+
+    Args:
+        * read_rows:
+            function returning the rows ``first`` to ``last`` (exclusive)
+            of the source image as ``uint8`` array
+        * shape:
+            ``(height, width[, bands])`` of the source image
+
+    Yields:
+        ``(top, strip)`` with the ``uint8`` array of up to ``strip_rows``
+        output rows starting at row ``top``
+    """
+    if kernel not in KERNELS:
+        raise ValueError(f'unknown kernel {kernel}, use one of {KERNELS}')
+    in_height, in_width = shape[:2]
+    bands = shape[2] if len(shape) == 3 else 1
+    if kernel == 'nearest':
+        index_x, _ = resample_weights(in_width, width, kernel)
+        index_y, _ = resample_weights(in_height, height, kernel)
+        for top in range(0, height, strip_rows):
+            rows = index_y[top:top + strip_rows, 0]
+            source = read_rows(rows[0], rows[-1] + 1)
+            yield top, source[rows - rows[0]][:, index_x[:, 0]]
+        return
+
+    blocks_x = _weight_blocks(in_width, width, kernel, wrap=True)
+    blocks_y = _weight_blocks(in_height, height, kernel)
+    blocks_per_strip = max(strip_rows // _BLOCK, 1)
+    for first_block in range(0, len(blocks_y), blocks_per_strip):
+        strip_blocks = blocks_y[first_block:first_block + blocks_per_strip]
+        top = strip_blocks[0][0]
+        rows = sum(matrix.shape[1] for _, _, matrix in strip_blocks)
+        first = strip_blocks[0][1].start
+        source_rows = read_rows(first, strip_blocks[-1][1].stop).reshape(
+            -1, in_width * bands
+        )
+
+        # vertically: (rows, in_width * bands), then transposed to
+        # (rows * bands, in_width) for the horizontal pass
+        scaled_y = np.empty((rows, in_width * bands), np.float32)
+        for start, source, matrix in strip_blocks:
+            scaled_y[start - top:start - top + matrix.shape[1]] = (
+                matrix.T @ source_rows[source.start - first:
+                                       source.stop - first].astype(np.float32)
+            )
+        scaled_y = np.ascontiguousarray(
+            scaled_y.reshape(rows, in_width, bands).transpose(0, 2, 1)
+        ).reshape(rows * bands, in_width)
+
+        strip = np.empty((rows * bands, width), np.float32)
+        for start, source, matrix in blocks_x:
+            strip[:, start:start + matrix.shape[1]] = (
+                scaled_y[:, source] @ matrix
+            )
+        del scaled_y
+        np.clip(np.rint(strip, out=strip), 0, 255, out=strip)
+        strip = strip.astype(np.uint8).reshape(rows, bands, width)
+        yield top, strip.transpose(0, 2, 1).reshape(
+            (rows, width) + tuple(shape[2:])
+        )
+
+
+def _decode_scaled(image, width, height):
+    """
+    Decode ``image`` as small as possible but at least ``width`` x
+    ``height``, as ``L`` or ``RGB``
+    """
+    image.draft(image.mode, (width, height))
+    if image.mode not in ('L', 'RGB'):
+        return image.convert('RGB')
+    image.load()
+    return image
+
+
+def _image_shape(image):
+    return ((image.height, image.width) if image.mode == 'L'
+            else (image.height, image.width, 3))
+
+
+def load_resampled(path, width, height, kernel='lanczos'):
+    """
+    Decode an image scaled to ``width`` x ``height`` with ``kernel``
+
+    For JPEG images the decoder already scales down as far as the image
+    stays at least as large as the result, ``resample`` does the rest.
+
+    Returns:
+        ``uint8`` array of shape ``(height, width)`` or
+        ``(height, width, bands)``
+    """
+    with Image.open(path) as image:
+        array = np.asarray(_decode_scaled(image, width, height))
+    if array.shape[:2] == (height, width):
+        return array
+    return resample(array, width, height, kernel)
+
+
+def save_scaled(source, out_file, width, height, quality=90, kernel='box',
+                pipeline=None, format='JPEG', strip_rows=128):
+    """
+    Write ``source`` scaled to ``width`` x ``height`` as JPEG (or another
+    ``format``), post-processed by ``pipeline``
+
+    The result is computed in strips of ``strip_rows`` rows directly from
+    the decoded image, so besides the decoded and the written image only
+    one strip is held in memory.
+
+    Args:
+        * source:
+            image file to decode
+        * out_file:
+            file (or file object) the image is written to
+        * width:
+            width of the written image
+        * height:
+            height of the written image
+        * quality:
+            JPEG quality of the written image
+        * kernel:
+            one of ``KERNELS``, integer downscaling with ``box`` averages
+            whole blocks of pixels
+        * pipeline:
+            ``postprocess.Pipeline`` applied to every strip
+        * format:
+            Pillow format name of the written image
+    """
+    with Image.open(source) as image:
+        if (kernel == 'box' and not image.width % width and
+                not image.height % height):
+            array = load_scaled(source, width, height)
+            mode = 'L' if array.ndim == 2 else 'RGB'
+            strips = ((top, array[top:top + strip_rows])
+                      for top in range(0, height, strip_rows))
+        else:
+            decoded = _decode_scaled(image, width, height)
+            mode = decoded.mode
+
+            def read_rows(first, last):
+                return np.asarray(
+                    decoded.crop((0, first, decoded.width, last))
+                )
+
+            if decoded.size != (width, height):
+                strips = resample_strips(read_rows, _image_shape(decoded),
+                                         width, height, kernel, strip_rows)
+            elif pipeline is not None:
+                strips = ((top, read_rows(top, min(top + strip_rows, height)))
+                          for top in range(0, height, strip_rows))
+            else:
+                decoded.save(out_file, format=format, quality=quality)
+                return
+
+        if pipeline is not None:
+            mode = pipeline.mode(mode)
+            strips = ((top, pipeline.apply(strip)) for top, strip in strips)
+        result = Image.new(mode, (width, height))
+        for top, strip in strips:
+            result.paste(Image.fromarray(strip, mode), (0, top))
+        strips = array = decoded = None
+        result.save(out_file, format=format, quality=quality)
@@ -0,0 +1,205 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    The download was not attempted because the circuit breaker is open
+    """
+
+
+class RetryPolicy(object):
+
+    """
+    Number of retries of a failed download and the delay before each of
+    them: a random time up to ``backoff * 2 ** attempt`` seconds, capped at
+    ``max_backoff`` seconds ("full jitter"), so that many clients failing at
+    the same time do not retry in lockstep
+    """
+
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30, jitter=True):
+        """
+        Args:
+            * retries:
+                number of retries after the first attempt
+            * backoff:
+                upper limit of the delay before the first retry in seconds,
+                doubled for every further retry
+            * max_backoff:
+                longest delay before a retry in seconds
+            * jitter:
+                wait a random time up to the limit instead of the limit
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """
+        Return the number of seconds to wait after the failed ``attempt``
+        (starting at 0)
+        """
+        limit = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, limit) if self.jitter else limit
+
+
+class CircuitBreaker(object):
+
+    """
+    Stop sending requests to an unavailable server
+
+    After ``failure_threshold`` failed downloads in a row the breaker opens
+    and downloads fail immediately with ``CircuitOpenError`` for
+    ``reset_timeout`` seconds. Then it is half-open and a single download
+    is let through as probe: it closes the breaker if it succeeds and opens
+    it again if it fails. The state is kept in a JSON file, so it is shared
+    by consecutive runs (e.g. from cron) and concurrent processes.
+
+    The downloads of several maps in one ``run`` count as a single
+    download, so one run with an unavailable server is one failure.
+    """
+
+    def __init__(self, path, failure_threshold=3, reset_timeout=300):
+        """
+        Args:
+            * path:
+                file the state is kept in
+            * failure_threshold:
+                number of failed downloads in a row which open the breaker
+            * reset_timeout:
+                seconds until an open breaker lets a probe through
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.path = Path(path)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._run = None
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        state.setdefault('state', 'closed')
+        state.setdefault('failures', 0)
+        state.setdefault('opened', 0.0)
+        return state
+
+    def _write(self, state):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def retry_in(self):
+        """
+        Return the number of seconds until the breaker lets the next request
+        through, 0 if requests are allowed now
+        """
+        state = self._read()
+        if state['state'] == 'closed':
+            return 0
+        return max(state['opened'] + self.reset_timeout - time.time(), 0)
+
+    @contextmanager
+    def run(self):
+        """
+        Treat all downloads in the ``with`` block as one: the breaker is
+        checked by the first one only and the others follow its decision.
+        At the end a success is recorded if any download succeeded,
+        otherwise a failure if any failed.
+        """
+        with self._lock:
+            self._run = {'allowed': None, 'successes': 0, 'failures': 0}
+        try:
+            yield self
+        finally:
+            with self._lock:
+                run, self._run = self._run, None
+            if run['successes']:
+                self.record_success()
+            elif run['failures']:
+                self.record_failure()
+
+    def allow(self):
+        """
+        Raise ``CircuitOpenError`` if no request should be sent now
+        """
+        with self._lock:
+            if self._run is not None and self._run['allowed'] is not None:
+                if self._run['allowed'] is not True:
+                    raise self._run['allowed']
+                return
+            try:
+                self._allow()
+            except CircuitOpenError as e:
+                if self._run is not None:
+                    self._run['allowed'] = e
+                raise
+            if self._run is not None:
+                self._run['allowed'] = True
+
+    def _allow(self):
+        """
+        Check the stored state, let a probe through if the breaker is due
+        """
+        state = self._read()
+        now = time.time()
+        if state['state'] == 'closed':
+            self.logger.debug(
+                f'circuit closed, {state["failures"]} failures'
+            )
+            return
+        retry_in = state['opened'] + self.reset_timeout - now
+        if retry_in > 0:
+            raise CircuitOpenError(
+                f'circuit {state["state"]} after {state["failures"]} '
+                f'failures, next attempt in {retry_in:.0f} s'
+            )
+        # let one probe through, further requests wait for its result
+        state['state'] = 'half-open'
+        state['opened'] = now
+        self._write(state)
+        self.logger.debug('circuit half-open, sending probe')
+
+    def record_success(self):
+        with self._lock:
+            if self._run is not None:
+                self._run['successes'] += 1
+                return
+            state = self._read()
+            if state['state'] != 'closed' or state['failures']:
+                self.logger.debug(f'circuit {state["state"]} -> closed')
+                self._write({'state': 'closed', 'failures': 0,
+                             'opened': 0.0})
+
+    def record_failure(self):
+        with self._lock:
+            if self._run is not None:
+                self._run['failures'] += 1
+                return
+            state = self._read()
+            state['failures'] += 1
+            if (state['state'] == 'half-open' or
+                    state['failures'] >= self.failure_threshold):
+                if state['state'] != 'open':
+                    self.logger.warning(
+                        f'circuit open after {state["failures"]} failures, '
+                        f'no requests for {self.reset_timeout} s'
+                    )
+                state['state'] = 'open'
+                state['opened'] = time.time()
+            self.logger.debug(
+                f'circuit {state["state"]}, {state["failures"]} failures'
+            )
+            self._write(state)
@@ -0,0 +1,121 @@
+import logging
+import statistics
+import time
+
+from .live_cloud_maps import read_history
+
+
+class AdaptiveScheduler(object):
+
+    """
+    Choose the delay until the next poll from the update history recorded by
+    ``CloudMap.download``: poll every ``min_interval`` seconds during
+    ``window`` seconds after the next expected update and back off up to
+    ``max_interval`` seconds in between
+    """
+
+    def __init__(self, history_file, min_interval=60, max_interval=3600,
+                 window=600, default_interval=600):
+        """
+        Args:
+            * history_file:
+                update history of one of the downloaded images
+            * min_interval:
+                delay between polls right after the expected update
+            * max_interval:
+                longest delay between two polls
+            * window:
+                length of the dense polling period after the expected
+                update
+            * default_interval:
+                delay between polls while the history is too short to
+                estimate the update period
+        """
+        self.logger = logging.getLogger('create_map_logger')
+        self.history_file = history_file
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window = window
+        self.default_interval = default_interval
+
+        self.requests = 0
+        self.staleness = []
+        history = read_history(history_file)
+        self._last_seen = history[-1][1] if history else None
+
+    def estimate(self, history):
+        """
+        Estimate the update period as median of the intervals between the
+        recorded ``Last-Modified`` times
+
+        Returns:
+            tuple ``(period, last_modified)`` or ``None`` if the history is
+            too short
+        """
+        modified = sorted({last_modified for last_modified, _ in history})
+        intervals = [b - a for a, b in zip(modified, modified[1:]) if b > a]
+        if len(intervals) < 2:
+            return None
+        return statistics.median(intervals), modified[-1]
+
+    def next_delay(self, now=None):
+        """
+        Return the number of seconds to wait before the next poll
+        """
+        now = time.time() if now is None else now
+        estimate = self.estimate(read_history(self.history_file))
+        if estimate is None:
+            return self.default_interval
+        period, last_modified = estimate
+
+        expected = last_modified + period
+        while expected + period <= now:
+            expected += period
+
+        if now < expected:
+            delay = expected - now
+        elif now < expected + self.window:
+            delay = self.min_interval
+        else:
+            # the update is late: back off, but wake up for the next one
+            delay = min(now - expected - self.window,
+                        expected + period - now)
+        self.logger.debug(
+            f'update period {period:.0f} s, next update expected in '
+            f'{expected - now:.0f} s'
+        )
+        return min(max(delay, self.min_interval), self.max_interval)
+
+    def record_poll(self, requests=1):
+        """
+        Count the requests of a finished poll and the staleness of an update
+        found by it
+
+        Returns:
+            the staleness of the newly found update in seconds, or ``None``
+        """
+        self.requests += requests
+        history = read_history(self.history_file)
+        if not history or history[-1][1] == self._last_seen:
+            return None
+        last_modified, self._last_seen = history[-1]
+        staleness = self._last_seen - last_modified
+        self.staleness.append(staleness)
+        self.logger.info(
+            f'update found {staleness:.0f} s after it was published, '
+            + self.summary()
+        )
+        return staleness
+
+    def summary(self):
+        """
+        Return the achieved staleness compared to the number of requests
+        """
+        if not self.staleness:
+            return f'{self.requests} requests, no updates found yet'
+        return (
+            f'{len(self.staleness)} updates, staleness mean '
+            f'{statistics.mean(self.staleness):.0f} s, max '
+            f'{max(self.staleness):.0f} s, {self.requests} requests '
+            f'({self.requests / len(self.staleness):.1f} per update)'
+        )
@@ -0,0 +1,138 @@
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+_write_lock = threading.Lock()
+
+
+class DownloadStats(object):
+
+    """
+    Time spent in every phase and bytes transferred by one
+    ``CloudMap.download`` call, which is true if a new image was written
+
+    The phases are
+
+    * ``request``: sending the (conditional) request until the response
+      headers are received, i.e. connecting, TLS and time to first byte
+    * ``download``: reading the body from the network (for segmented
+      downloads the wall time of all segments including their writes)
+    * ``write``: writing the body into the ``.part`` file
+    * ``hash``: computing the SHA-256 of the image
+    * ``rename``: setting the modification time, renaming the ``.part``
+      file and writing the metadata and history
+    * ``cache``: adding the image to or restoring it from the cache
+    * ``retry wait``: backing off between attempts
+    * ``lock wait``: waiting for another process (or thread) downloading
+      the same image; ``coalesced`` is true if its result was reused
+    * ``decode``: decoding a new image into its pixel file
+    * ``change``: scoring a new image with the change detector
+    * ``render``: scaling and post-processing a map rendered locally from
+      its downloaded source map
+
+    and the bytes are counted as ``received`` from the network, ``written``
+    to disk and ``resumed`` from an earlier partial download.
+
+    ``unchanged`` is true if a new upstream version had the same content as
+    the existing image, which was kept (so ``updated`` is false).
+    ``change`` is the score of a new image by the change detector and
+    ``significant`` whether it reached the threshold, both are ``None``
+    without a detector.
+    """
+
+    def __init__(self, url=None, path=None):
+        self.url = url
+        self.path = path
+        self.status = None
+        self.updated = False
+        self.attempts = 0
+        self.error = None
+        self.coalesced = False
+        self.unchanged = False
+        self.change = None
+        self.significant = None
+        self.started = time.time()
+        self.seconds = {}
+        self.bytes = {'received': 0, 'written': 0, 'resumed': 0}
+        self._lock = threading.Lock()
+        self._tic = time.perf_counter()
+
+    def __bool__(self):
+        return self.updated
+
+    def __str__(self):
+        phases = ', '.join(f'{name} {seconds:.3f} s'
+                           for name, seconds in self.seconds.items())
+        return (f'{self.path}: {phases}, '
+                f'{self.bytes["received"]} bytes received')
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the ``with`` block to the phase ``name``
+        """
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - tic)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def add_bytes(self, name, count):
+        with self._lock:
+            self.bytes[name] += count
+
+    def include(self, other):
+        """
+        Take over the response, attempts, phases and bytes of ``other``,
+        the stats of the download of the source map of a rendered map
+        """
+        self.url = other.url
+        self.status = other.status
+        self.attempts += other.attempts
+        self.coalesced = other.coalesced
+        self.unchanged = other.unchanged
+        self.change = other.change
+        self.significant = other.significant
+        for name, seconds in other.seconds.items():
+            if name != 'total':
+                self.add_time(name, seconds)
+        for name, count in other.bytes.items():
+            self.add_bytes(name, count)
+
+    def finish(self):
+        """
+        Record the total time of the download
+        """
+        self.seconds['total'] = time.perf_counter() - self._tic
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'url': self.url,
+            'path': str(self.path),
+            'status': self.status,
+            'updated': self.updated,
+            'attempts': self.attempts,
+            'error': self.error,
+            'coalesced': self.coalesced,
+            'unchanged': self.unchanged,
+            'change': self.change,
+            'significant': self.significant,
+            'seconds': dict(self.seconds),
+            'bytes': dict(self.bytes),
+        }
+
+
+def write_stats(path, stats):
+    """
+    Append ``stats`` as JSON line to the file ``path``
+    """
+    line = json.dumps(stats.as_dict()) + '\n'
+    with _write_lock:
+        with open(path, 'a') as f:
+            f.write(line)
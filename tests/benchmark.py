@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmarks of the cloud map downloads against the local
+``FakeCloudServer``
+
+Every measured run is a separate worker process, so its peak RSS is its
+own. The results are compared with ``benchmark_baseline.json`` and the
+script exits with status 1 if a metric regressed::
+
+  $ python tests/benchmark.py                    # run and compare
+  $ python tests/benchmark.py -k fresh segmented # only some scenarios
+  $ python tests/benchmark.py --save-baseline    # store new baseline
+
+Some metrics also have an absolute budget in ``BUDGET``, which is checked
+independently of the baseline.
+"""
+from pathlib import Path
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_server import RESOLUTIONS, FakeCloudServer, synthetic_map
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+
+# allowed deviation from the baseline: (factor, absolute slack), rates are
+# only shown because they follow from the times which are checked
+TOLERANCE = {
+    's': (1.5, 0.25),
+    'MB/s': None,
+    '1/s': None,
+    'MB': (1.25, 5),
+    'requests': (1, 0),
+    'bytes': (1.01, 0),
+    'ms': (1.5, 5),
+    'modules': (1, 0),
+}
+
+# segment counts of the segmented scenario
+SEGMENTS = (1, 4)
+
+# chunk_size of the clients: a segment stops reading at the end of its
+# range, so the server may already have sent up to one chunk more, which
+# depends on the timing
+CHUNK_SIZE = 64 * 1024
+
+# absolute slack of single metrics in addition to their TOLERANCE
+SLACK = {f'{segments} segments: bytes': segments * CHUNK_SIZE
+         for segments in SEGMENTS}
+
+# upper limits independent of the baseline
+BUDGET = {
+    'import: cloudmap.create_map': 75,
+    'import: heavy modules': 0,
+}
+
+# sizes of the resampling benchmark, derived from 8192x4096 or scaled from
+# the smallest upstream resolution covering them
+RESAMPLE_SIZES = [(1024, 512), (1920, 960), (2048, 1024), (3840, 1920),
+                  (4096, 2048), (5120, 2560)]
+
+# modules which are only needed for downloads or optional features
+HEAVY_MODULES = ('requests', 'urllib3', 'dateutil', 'numpy', 'PIL',
+                 'aiohttp', 'http.server')
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in MB, or ``None``
+    if it cannot be determined
+    """
+    # on Linux ru_maxrss includes the parent process before the exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def worker(spec):
+    """
+    Run one download described by ``spec`` in this process and return the
+    wall time and peak RSS
+    """
+    sys.path.insert(0, str(ROOT))
+    if spec.get('kernel'):
+        return resample_worker(spec)
+    from cloudmap.live_cloud_maps import download_all
+    from cloudmap.retry import RetryPolicy
+    # the retries of the fault injection are expected
+    logging.getLogger('create_map_logger').setLevel(logging.ERROR)
+
+    targets = [(width, height, spec['outdir'], f'clouds_{width}.jpg')
+               for width, height in spec['resolutions']]
+    rss_before = peak_rss()
+    tic = time.perf_counter()
+    if spec.get('clients'):
+        # many independent nodes downloading from the same server
+        def client(i):
+            client_targets = [
+                (width, height, str(Path(outdir) / f'client{i}'), outfile)
+                for width, height, outdir, outfile in targets
+            ]
+            start = time.perf_counter()
+            download_all(client_targets, max_workers=1,
+                         base_url=spec['base_url'])
+            latencies.append(time.perf_counter() - start)
+
+        latencies = []
+        threads = [threading.Thread(target=client, args=(i,))
+                   for i in range(spec['clients'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        extra = {
+            'p50': latencies[len(latencies) // 2],
+            'p95': latencies[int(len(latencies) * 0.95)],
+        }
+    else:
+        download_all(targets, force=spec.get('force', False),
+                     max_workers=spec.get('jobs', 4),
+                     derive=spec.get('derive', False),
+                     segments=spec.get('segments', 1),
+                     base_url=spec['base_url'],
+                     retry=RetryPolicy(backoff=0.01, max_backoff=0.1))
+        extra = {}
+    return dict(seconds=time.perf_counter() - tic, rss=peak_rss(),
+                rss_import=rss_before, **extra)
+
+
+def resample_worker(spec):
+    """
+    Scale ``spec['source']`` to the size of ``spec`` with its kernel and
+    return the wall time and peak RSS
+    """
+    import io
+    from cloudmap.resample import save_scaled
+
+    rss_before = peak_rss()
+    tic = time.perf_counter()
+    save_scaled(spec['source'], io.BytesIO(), spec['width'], spec['height'],
+                kernel=spec['kernel'])
+    return dict(seconds=time.perf_counter() - tic, rss=peak_rss(),
+                rss_import=rss_before)
+
+
+def run_worker(spec):
+    output = subprocess.run(
+        [sys.executable, __file__, '--worker', json.dumps(spec)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def measure(server, spec, prefix=''):
+    """
+    Run ``spec`` in a worker against ``server`` and return the metrics
+    prefixed by ``prefix``
+    """
+    for width, height in spec['resolutions']:
+        # generate the maps before the clock starts
+        server.get(width, height)
+    server.reset_stats()
+    result = run_worker(dict(spec, base_url=spec.get('base_url',
+                                                     server.base_url)))
+    metrics = {
+        'time': (result['seconds'], 's'),
+        'throughput': (server.stats['bytes'] / 1e6 / result['seconds'],
+                       'MB/s'),
+        'requests': (server.requests(), 'requests'),
+        'bytes': (server.stats['bytes'], 'bytes'),
+    }
+    if result['rss'] is not None:
+        metrics['peak rss'] = (result['rss'], 'MB')
+        metrics['rss above imports'] = (result['rss'] - result['rss_import'],
+                                        'MB')
+    for key in ('p50', 'p95'):
+        if key in result:
+            metrics[f'client {key}'] = (result[key], 's')
+    return {prefix + name: value for name, value in metrics.items()}
+
+
+def scenario_fresh(args, workdir):
+    """
+    All resolutions downloaded into an empty directory, then checked again
+    without changes, then forcefully reloaded
+    """
+    outdir = str(workdir / 'maps')
+    spec = {'outdir': outdir, 'resolutions': args.resolutions,
+            'jobs': args.jobs}
+    with FakeCloudServer(latency=args.latency,
+                         bandwidth=args.bandwidth) as server:
+        metrics = measure(server, spec, 'fresh: ')
+        metrics.update(measure(server, spec, 'unchanged: '))
+        metrics.update(measure(server, dict(spec, force=True), 'forced: '))
+    return metrics
+
+
+def scenario_memory(args, workdir):
+    """
+    Peak RSS of downloading the smallest and the largest map, which should
+    be the same with streaming downloads
+    """
+    metrics = {}
+    with FakeCloudServer(latency=args.latency,
+                         bandwidth=args.bandwidth) as server:
+        for resolution in (RESOLUTIONS[0], RESOLUTIONS[-1]):
+            spec = {'outdir': str(workdir / f'memory{resolution[0]}'),
+                    'resolutions': [resolution]}
+            result = measure(server, spec, f'{resolution[0]}: ')
+            metrics.update({name: value for name, value in result.items()
+                            if 'rss' in name or 'bytes' in name})
+    return metrics
+
+
+def scenario_segmented(args, workdir):
+    """
+    Largest map over a link with 50 ms latency and a bandwidth cap per
+    connection, in a single stream and in 4 segments
+    """
+    metrics = {}
+    with FakeCloudServer(latency=0.05,
+                         bandwidth=args.bandwidth or 4e6) as server:
+        for segments in SEGMENTS:
+            spec = {'outdir': str(workdir / f'segments{segments}'),
+                    'resolutions': [RESOLUTIONS[-1]], 'segments': segments}
+            metrics.update(measure(server, spec, f'{segments} segments: '))
+    return metrics
+
+
+def scenario_derive(args, workdir):
+    """
+    All resolutions with the smaller ones derived from the largest one
+    """
+    try:
+        import numpy  # noqa: F401
+        import PIL  # noqa: F401
+    except ImportError:
+        return {}
+    spec = {'outdir': str(workdir / 'derive'),
+            'resolutions': args.resolutions, 'derive': True}
+    with FakeCloudServer(latency=args.latency,
+                         bandwidth=args.bandwidth) as server:
+        return measure(server, spec, 'derive: ')
+
+
+def scenario_faults(args, workdir):
+    """
+    All resolutions one after the other while half of the requests fail
+    """
+    spec = {'outdir': str(workdir / 'faults'),
+            'resolutions': args.resolutions, 'jobs': 1}
+    with FakeCloudServer(latency=args.latency, bandwidth=args.bandwidth,
+                         fault_rate=0.5) as server:
+        return measure(server, spec, 'faults: ')
+
+
+def scenario_mirror(args, workdir):
+    """
+    Many clients downloading the 2048x1024 map concurrently from a
+    ``MirrorServer`` (``create_map --serve``)
+    """
+    sys.path.insert(0, str(ROOT))
+    from cloudmap.mirror_server import MirrorServer, mirror_targets
+    outdir = str(workdir / 'mirror')
+    with FakeCloudServer() as upstream:
+        run_worker({'outdir': outdir, 'resolutions': RESOLUTIONS,
+                    'base_url': upstream.base_url})
+
+    server = MirrorServer(mirror_targets(outdir), ('127.0.0.1', 0))
+    server.start()
+    try:
+        host, port = server.httpd.server_address[:2]
+        result = run_worker({
+            'outdir': str(workdir / 'clients'),
+            'resolutions': [(2048, 1024)],
+            'base_url': f'http://{host}:{port}',
+            'clients': args.clients,
+        })
+    finally:
+        server.shutdown()
+    return {
+        'mirror: time': (result['seconds'], 's'),
+        'mirror: client p50': (result['p50'], 's'),
+        'mirror: client p95': (result['p95'], 's'),
+        'mirror: downloads/s': (args.clients / result['seconds'], '1/s'),
+    }
+
+
+def scenario_resample(args, workdir):
+    """
+    Every kernel scaling a map to every size of ``RESAMPLE_SIZES`` from the
+    upstream resolution a ``CloudMap`` of that size uses
+    """
+    try:
+        import numpy  # noqa: F401
+        import PIL  # noqa: F401
+    except ImportError:
+        return {}
+    sys.path.insert(0, str(ROOT))
+    from cloudmap.live_cloud_maps import CloudMapBase
+    from cloudmap.resample import KERNELS
+
+    metrics = {}
+    for width, height in RESAMPLE_SIZES:
+        source_size = CloudMapBase.source_resolution(width, height)
+        if source_size == (width, height):
+            source_size = CloudMapBase.available_resolutions[-1]
+        source = workdir / 'source_{}x{}.jpg'.format(*source_size)
+        if not source.exists():
+            source.write_bytes(synthetic_map(*source_size, 0))
+        for kernel in KERNELS:
+            result = run_worker({'kernel': kernel, 'source': str(source),
+                                 'width': width, 'height': height})
+            prefix = f'resample {kernel} {width}x{height}: '
+            metrics[prefix + 'time'] = (result['seconds'], 's')
+            if result['rss'] is not None:
+                metrics[prefix + 'rss above imports'] = (
+                    result['rss'] - result['rss_import'], 'MB'
+                )
+    return metrics
+
+
+def import_time(module, runs=5):
+    """
+    Return the best cumulative import time of ``module`` in ms measured
+    with ``python -X importtime`` in fresh processes
+    """
+    times = []
+    for _ in range(runs):
+        stderr = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            check=True, cwd=ROOT, stderr=subprocess.PIPE,
+            universal_newlines=True
+        ).stderr
+        for line in stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1000)
+    return min(times)
+
+
+def command_time(command, runs=5):
+    """
+    Return the best wall time of ``command`` in ms
+    """
+    times = []
+    for _ in range(runs):
+        tic = time.perf_counter()
+        subprocess.run(command, check=True, cwd=ROOT,
+                       stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - tic) * 1000)
+    return min(times)
+
+
+def scenario_importtime(args, workdir):
+    """
+    Start-up cost of ``create_map``: the import time of the module, the wall
+    time of ``--version`` and ``--help`` and the number of heavy modules
+    imported with it
+    """
+    check = ('import sys, cloudmap.create_map; '
+             f'print(sum(m in sys.modules for m in {HEAVY_MODULES!r}))')
+    heavy = subprocess.run(
+        [sys.executable, '-c', check], check=True, cwd=ROOT,
+        stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    metrics = {
+        'import: cloudmap': (import_time('cloudmap'), 'ms'),
+        'import: cloudmap.create_map': (import_time('cloudmap.create_map'),
+                                        'ms'),
+        'import: heavy modules': (int(heavy), 'modules'),
+    }
+    for option in ('--version', '--help'):
+        metrics[f'import: create_map {option}'] = (command_time(
+            [sys.executable, '-m', 'cloudmap.create_map', option]
+        ), 'ms')
+    return metrics
+
+
+SCENARIOS = {
+    'fresh': scenario_fresh,
+    'memory': scenario_memory,
+    'segmented': scenario_segmented,
+    'derive': scenario_derive,
+    'faults': scenario_faults,
+    'mirror': scenario_mirror,
+    'resample': scenario_resample,
+    'importtime': scenario_importtime,
+}
+
+
+def compare(results, baseline):
+    """
+    Print the results next to the baseline and return the regressed metrics
+    """
+    regressions = []
+    for name, (value, unit) in results.items():
+        reference = baseline.get(name)
+        line = f'{name:40} {value:14.3f} {unit:8}'
+        if reference is not None:
+            line += f' baseline {reference[0]:14.3f}'
+            factor, slack = TOLERANCE.get(unit) or (float('inf'), 0)
+            slack += SLACK.get(name, 0)
+            if value > reference[0] * factor + slack:
+                line += '  REGRESSION'
+                regressions.append(name)
+        if name in BUDGET and value > BUDGET[name]:
+            line += f'  OVER BUDGET {BUDGET[name]}'
+            if name not in regressions:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def parse_resolution(spec):
+    width, _, height = spec.lower().partition('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument('-k', '--scenarios', nargs='+',
+                        choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('-r', '--resolutions', nargs='+',
+                        type=parse_resolution, default=RESOLUTIONS,
+                        metavar='WIDTHxHEIGHT')
+    parser.add_argument('-j', '--jobs', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before every response of the server')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bytes per second per connection')
+    parser.add_argument('--clients', type=int, default=50,
+                        help='concurrent clients of the mirror benchmark')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as new baseline')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(json.loads(args.worker))))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios:
+            results.update(SCENARIOS[name](args, Path(workdir)))
+
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': baseline}, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print(f'baseline saved in {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regressions')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""
+Local stand-in for https://clouds.matteason.co.uk/ used by the benchmarks
+
+Serves deterministic synthetic cloud maps at every size of
+``CloudMapBase.available_resolutions`` with ``ETag``/``Last-Modified``
+validators, conditional requests (304) and single byte ranges. Latency,
+a per connection bandwidth cap and faults (503 answers or connections
+closed in the middle of the body) can be injected.
+
+Run it on its own to point ``create_map`` at it with ``baseurl``::
+
+  $ python tests/fake_server.py --port 8000 --latency 0.1
+"""
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+
+RESOLUTIONS = [
+    (1024, 512),
+    (2048, 1024),
+    (4096, 2048),
+    (8192, 4096),
+]
+
+# first publication of the synthetic maps, so every run sees the same
+# Last-Modified dates
+EPOCH = 1700000000
+
+
+def synthetic_map(width, height, seed):
+    """
+    Return a JPEG of ``width`` x ``height`` pixels with random smooth
+    "clouds", which is the same for the same ``seed``
+
+    Without Pillow and numpy random bytes between the JPEG start and end
+    markers of roughly the size of a real map are returned, which is enough
+    for everything except decoding.
+    """
+    try:
+        import io
+        import numpy as np
+        from PIL import Image
+    except ImportError:
+        rng = random.Random(f'{width}x{height}/{seed}')
+        size = width * height // 4
+        return (b'\xff\xd8' + rng.getrandbits(8 * size).to_bytes(size, 'big')
+                + b'\xff\xd9')
+
+    rng = np.random.default_rng([width, height, seed])
+    coarse = rng.integers(0, 256, (height // 64, width // 64), dtype=np.uint8)
+    clouds = np.asarray(
+        Image.fromarray(coarse).resize((width, height), Image.BICUBIC),
+        dtype=np.int16
+    )
+    clouds += rng.integers(-6, 7, (height, width), dtype=np.int16)
+    image = Image.fromarray(np.clip(clouds, 0, 255).astype(np.uint8))
+    out = io.BytesIO()
+    image.convert('RGB').save(out, 'JPEG', quality=85)
+    return out.getvalue()
+
+
+class FakeCloudServer(object):
+
+    """
+    Threaded HTTP server serving the synthetic maps at
+    ``/images/<width>x<height>/clouds.jpg``
+
+    ``stats`` counts the requests per ``'<method> <status>'`` and the body
+    bytes sent. ``publish`` replaces all maps by a new version.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, fault_rate=0.0, seed=0,
+                 ranges=True, address=('127.0.0.1', 0)):
+        """
+        Args:
+            * latency:
+                seconds before every response is sent
+            * bandwidth:
+                maximum bytes per second sent on one connection
+            * fault_rate:
+                probability that a GET fails
+            * seed:
+                seed of the maps and of the faults
+            * ranges:
+                answer range requests, otherwise the whole map is sent
+            * address:
+                ``(host, port)`` the server listens on, port 0 picks a free
+                one
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_rate = fault_rate
+        self.ranges = ranges
+        self.version = 0
+        self._content_version = 0
+        self._seed = seed
+        self._random = random.Random(seed)
+        self._maps = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        server = self
+
+        class Handler(_FakeHandler):
+            fake = server
+
+        self.httpd = _FakeHTTPServer(address, Handler)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': {}, 'bytes': 0}
+
+    def count(self, method, status, size=0):
+        with self._lock:
+            key = f'{method} {status}'
+            self.stats['requests'][key] = (
+                self.stats['requests'].get(key, 0) + 1
+            )
+            self.stats['bytes'] += size
+
+    def requests(self):
+        """
+        Return the total number of requests since the last ``reset_stats``
+        """
+        with self._lock:
+            return sum(self.stats['requests'].values())
+
+    def publish(self, changed=True):
+        """
+        Replace all maps by a new version published one hour later, with
+        the content of the current version unless ``changed`` is set
+        """
+        with self._lock:
+            self.version += 1
+            if changed:
+                self._content_version = self.version
+            self._maps.clear()
+
+    def fault(self):
+        """
+        Return the fault to inject into the next GET: ``None``, ``'error'``
+        or ``'disconnect'``
+        """
+        with self._lock:
+            if self._random.random() >= self.fault_rate:
+                return None
+            return self._random.choice(['error', 'disconnect'])
+
+    def get(self, width, height):
+        """
+        Return ``(body, etag, last_modified)`` of the current map
+        """
+        with self._lock:
+            key = (width, height, self.version)
+            if key not in self._maps:
+                body = synthetic_map(width, height,
+                                     self._seed * 1000 +
+                                     self._content_version)
+                etag = hashlib.md5(body + str(self.version).encode())
+                self._maps[key] = (
+                    body,
+                    f'"{etag.hexdigest()}"',
+                    formatdate(EPOCH + 3600 * self.version, usegmt=True),
+                )
+            return self._maps[key]
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing connections early (segments, faults) are expected
+        pass
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._send_map(body=False)
+
+    def do_GET(self):
+        self._send_map(body=True)
+
+    def _send_map(self, body):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+        match = re.fullmatch(r'/images/(\d+)x(\d+)/clouds\.jpg',
+                             self.path.partition('?')[0])
+        size = match and (int(match.group(1)), int(match.group(2)))
+        if size not in RESOLUTIONS:
+            self.fake.count(self.command, 404)
+            self.send_error(404)
+            return
+
+        fault = self.fake.fault() if body else None
+        if fault == 'error':
+            self.fake.count(self.command, 503)
+            self.send_error(503)
+            return
+
+        data, etag, last_modified = self.fake.get(*size)
+        if self._not_modified(etag, last_modified):
+            self.fake.count(self.command, 304)
+            self.send_response(304)
+            self._send_validators(etag, last_modified)
+            self.end_headers()
+            return
+
+        start, end = 0, len(data) - 1
+        byte_range = self._byte_range(etag, last_modified, len(data))
+        if byte_range is not None:
+            start, end = byte_range
+            if start >= len(data):
+                self.fake.count(self.command, 416)
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end}/{len(data)}')
+        else:
+            status = 200
+            self.send_response(200)
+        self._send_validators(etag, last_modified)
+        if self.fake.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            self.fake.count(self.command, status)
+            return
+
+        if fault == 'disconnect':
+            end = start + (end - start) // 2
+            self.close_connection = True
+        sent = self._write(memoryview(data)[start:end + 1])
+        self.fake.count(self.command, status, sent)
+
+    def _write(self, view, chunk_size=64 * 1024):
+        """
+        Send ``view`` at most at ``bandwidth`` bytes per second
+        """
+        tic = time.monotonic()
+        sent = 0
+        try:
+            for offset in range(0, len(view), chunk_size):
+                self.wfile.write(view[offset:offset + chunk_size])
+                sent += len(view[offset:offset + chunk_size])
+                if self.fake.bandwidth:
+                    ahead = sent / self.fake.bandwidth - (time.monotonic()
+                                                          - tic)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            self.close_connection = True
+        return sent
+
+    def _send_validators(self, etag, last_modified):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+
+    def _not_modified(self, etag, last_modified):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return (parsedate_to_datetime(last_modified) <=
+                        parsedate_to_datetime(if_modified_since))
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _byte_range(self, etag, last_modified, size):
+        if not self.fake.ranges:
+            return None
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)',
+                             self.headers.get('Range', '').strip())
+        if match is None or match.groups() == ('', ''):
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range not in (etag, last_modified):
+            return None
+        first, last = match.groups()
+        if not first:
+            return max(size - int(last), 0), size - 1
+        if last and int(last) < int(first):
+            return None
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before every response')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bytes per second per connection')
+    parser.add_argument('--faults', type=float, default=0.0,
+                        help='probability that a GET fails')
+    parser.add_argument('--no-ranges', action='store_true',
+                        help='ignore range requests')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeCloudServer(args.latency, args.bandwidth, args.faults,
+                             args.seed, not args.no_ranges,
+                             (args.host, args.port))
+    print(f'serving synthetic cloud maps on {server.base_url}/')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
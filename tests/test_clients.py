@@ -0,0 +1,287 @@
+"""
+Behavior shared by ``CloudMap`` and ``AsyncCloudMap``, every test runs
+against the ``FakeCloudServer`` with both clients
+"""
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from cloudmap.live_cloud_maps import CloudMap, download_all
+from cloudmap.lock import FileLock
+from cloudmap.retry import RetryPolicy
+from fake_server import FakeCloudServer, _FakeHandler
+
+SIZE = (2048, 1024)
+
+
+def sync_download(base_url, outdir, outfile, force, retry):
+    cloud_map = CloudMap(*SIZE, base_url=base_url, retry=retry)
+    return cloud_map.download(outdir, outfile, force)
+
+
+def async_download(base_url, outdir, outfile, force, retry):
+    from cloudmap.async_cloud_maps import AsyncCloudMap
+
+    async def download():
+        async with AsyncCloudMap(*SIZE, base_url=base_url) as cloud_map:
+            cloud_map.retry = retry
+            return await cloud_map.download(outdir, outfile, force)
+
+    return asyncio.run(download())
+
+
+@pytest.fixture
+def server():
+    with FakeCloudServer() as fake:
+        yield fake
+
+
+@pytest.fixture(params=['sync', 'async'])
+def download(request, server, tmp_path):
+    """
+    Download the map from ``server`` into ``tmp_path/clouds.jpg`` with the
+    client of the test run
+    """
+    if request.param == 'async':
+        pytest.importorskip('aiohttp')
+    function = sync_download if request.param == 'sync' else async_download
+
+    def download(force=False, retries=0):
+        return function(server.base_url, tmp_path, 'clouds.jpg', force,
+                        RetryPolicy(retries, backoff=0.01))
+
+    return download
+
+
+def inject(server, *faults):
+    """
+    Make the next GET requests to ``server`` fail with ``faults``
+    (``'error'`` or ``'disconnect'``), the later ones succeed
+    """
+    pending = list(faults)
+    server.fault = lambda: pending.pop(0) if pending else None
+
+
+def read_map(tmp_path):
+    return (tmp_path / 'clouds.jpg').read_bytes()
+
+
+def read_metadata(tmp_path):
+    with open(tmp_path / 'clouds.jpg.json') as f:
+        return json.load(f)
+
+
+def test_fresh(download, server, tmp_path):
+    stats = download()
+    body, etag, last_modified = server.get(*SIZE)
+    assert stats.updated
+    assert stats.status == 200
+    assert read_map(tmp_path) == body
+    assert read_metadata(tmp_path)['etag'] == etag
+    assert os.stat(tmp_path / 'clouds.jpg').st_mtime == (
+        parsedate_to_datetime(last_modified).timestamp()
+    )
+
+
+def test_not_modified(download, server, tmp_path):
+    download()
+    stats = download()
+    assert not stats.updated
+    assert stats.status == 304
+    assert stats.bytes['received'] == 0
+
+
+def test_forced_same_content_is_kept(download, server, tmp_path):
+    download()
+    inode = os.stat(tmp_path / 'clouds.jpg').st_ino
+    stats = download(force=True)
+    assert stats.status == 200
+    assert not stats.updated
+    assert stats.unchanged
+    assert os.stat(tmp_path / 'clouds.jpg').st_ino == inode
+
+
+def test_forced_replaces_damaged_map(download, server, tmp_path):
+    download()
+    with open(tmp_path / 'clouds.jpg', 'r+b') as f:
+        f.write(b'damaged')
+    stats = download(force=True)
+    assert stats.updated
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_new_version(download, server, tmp_path):
+    download()
+    server.publish()
+    stats = download()
+    assert stats.updated
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_unchanged_content(download, server, tmp_path):
+    download()
+    inode = os.stat(tmp_path / 'clouds.jpg').st_ino
+    server.publish(changed=False)
+    stats = download()
+    _, etag, last_modified = server.get(*SIZE)
+    assert stats.status == 200
+    assert not stats.updated
+    assert stats.unchanged
+    assert os.stat(tmp_path / 'clouds.jpg').st_ino == inode
+    assert os.stat(tmp_path / 'clouds.jpg').st_mtime == (
+        parsedate_to_datetime(last_modified).timestamp()
+    )
+    assert read_metadata(tmp_path)['etag'] == etag
+
+
+def write_part(server, tmp_path, length):
+    """
+    Leave the first ``length`` bytes of the current map as partial download
+    """
+    body, etag, last_modified = server.get(*SIZE)
+    url = server.base_url + '/images/{}x{}/clouds.jpg'.format(*SIZE)
+    (tmp_path / 'clouds.jpg.part').write_bytes(body[:length])
+    with open(tmp_path / 'clouds.jpg.part.json', 'w') as f:
+        json.dump({'url': url, 'etag': etag, 'last-modified': last_modified},
+                  f)
+
+
+def test_resume(download, server, tmp_path):
+    write_part(server, tmp_path, 100000)
+    stats = download()
+    assert stats.updated
+    assert stats.status == 206
+    assert stats.bytes['resumed'] == 100000
+    assert stats.bytes['received'] == len(server.get(*SIZE)[0]) - 100000
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+    assert not (tmp_path / 'clouds.jpg.part').exists()
+
+
+def test_resume_of_old_version(download, server, tmp_path):
+    write_part(server, tmp_path, 100000)
+    server.publish()
+    stats = download()
+    assert stats.updated
+    assert stats.status == 200
+    assert stats.bytes['resumed'] == 0
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_disconnect_keeps_part(download, server, tmp_path):
+    inject(server, 'disconnect')
+    with pytest.raises(Exception):
+        download()
+    assert not (tmp_path / 'clouds.jpg').exists()
+    assert (tmp_path / 'clouds.jpg.part').exists()
+
+    stats = download()
+    assert stats.updated
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+    assert not (tmp_path / 'clouds.jpg.part').exists()
+
+
+def test_disconnect_is_retried(download, server, tmp_path):
+    inject(server, 'disconnect')
+    stats = download(retries=1)
+    assert stats.updated
+    assert stats.attempts == 2
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_server_error_is_retried(download, server, tmp_path):
+    inject(server, 'error', 'error')
+    stats = download(retries=2)
+    assert stats.updated
+    assert stats.attempts == 3
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_server_error_after_all_retries(download, server, tmp_path):
+    inject(server, 'error', 'error', 'error')
+    with pytest.raises(Exception):
+        download(retries=2)
+    assert server.stats['requests']['GET 503'] == 3
+    assert not (tmp_path / 'clouds.jpg').exists()
+
+
+def test_segments_without_served_ranges(server, tmp_path, monkeypatch):
+    # the server advertises ranges, but answers every request with 200
+    monkeypatch.setattr(_FakeHandler, '_byte_range', lambda self, *args: None)
+    cloud_map = CloudMap(*SIZE, base_url=server.base_url, segments=4,
+                         retry=RetryPolicy(0))
+    cloud_map.min_segment_size = 1024
+    stats = cloud_map.download(tmp_path, 'clouds.jpg', False)
+    assert stats.updated
+    assert stats.attempts == 1
+    assert server.stats['requests']['GET 200'] <= 5
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+    assert not (tmp_path / 'clouds.jpg.part').exists()
+
+
+def test_derived_maps_are_reported(server, tmp_path):
+    pytest.importorskip('PIL')
+    stats_file = tmp_path / 'stats.jsonl'
+    targets = [(width, height, tmp_path, f'clouds_{width}.jpg')
+               for width, height in [(1024, 512), SIZE]]
+    derived = []
+    for _ in range(2):
+        results = download_all(targets, base_url=server.base_url,
+                               derive=True, stats_file=stats_file)
+        derived.append(results[0])
+    assert all('render' in stats.seconds for stats in derived)
+    assert [stats.updated for stats in derived] == [True, False]
+    lines = [json.loads(line) for line in open(stats_file)]
+    assert len(lines) == 4
+    assert sum(line['path'].endswith('_1024.jpg') for line in lines) == 2
+    assert server.requests() == 2
+
+
+def test_concurrent_downloads_are_coalesced(server, tmp_path):
+    # hold the lock until all threads wait for it
+    lock = FileLock(tmp_path / 'clouds.jpg.lock')
+    lock.acquire()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(sync_download(
+            server.base_url, tmp_path, 'clouds.jpg', False, RetryPolicy(0)
+        )))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    lock.release()
+    for thread in threads:
+        thread.join()
+
+    assert [stats.coalesced for stats in results].count(False) == 1
+    assert all(stats.updated for stats in results)
+    assert server.requests() == 1
+    assert read_map(tmp_path) == server.get(*SIZE)[0]
+
+
+def test_async_concurrent_downloads_do_not_block_executor(server, tmp_path):
+    pytest.importorskip('aiohttp')
+    from cloudmap.async_cloud_maps import AsyncCloudMap
+
+    async def download_all():
+        # more downloads than threads of the executor
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(2))
+        async with AsyncCloudMap(*SIZE, base_url=server.base_url) as cloud_map:
+            return await asyncio.gather(*(
+                cloud_map.download(tmp_path, 'clouds.jpg', False)
+                for _ in range(8)
+            ))
+
+    results = asyncio.run(asyncio.wait_for(download_all(), 20))
+    assert [stats.coalesced for stats in results].count(False) == 1
+    assert all(stats.updated for stats in results)
+    assert server.requests() == 1
+    assert read_map(tmp_path) == server.get(*SIZE)[0]